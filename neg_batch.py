@@ -0,0 +1,331 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Batch mode of neg_process.py. All frames of a roll share the film base and each
+# frame gets its own profile. Frames are either processed by a pool of worker
+# processes, or by a pipeline in one process that overlaps decoding, rendering and
+# writing of consecutive frames.
+
+import concurrent.futures
+import glob
+import os
+import queue
+import threading
+import time
+import traceback
+import neg_process
+from pathlib import Path
+
+RAW_EXTENSIONS = ['.arw', '.cr2', '.cr3', '.dng', '.nef', '.orf', '.raf', '.rw2']
+
+
+def list_raw_files(roll, exclude=[]):
+    '''Returns the sorted RAW files in the directory |roll| or matching the glob |roll|.
+    Files in |exclude|, e.g. the film base capture, are skipped.'''
+    if os.path.isdir(roll):
+        raw_files = [os.path.join(roll, x) for x in os.listdir(roll)
+                     if Path(x).suffix.lower() in RAW_EXTENSIONS]
+    else:
+        raw_files = glob.glob(roll)
+    excluded = [os.path.realpath(x) for x in exclude if x]
+    return sorted(x for x in raw_files if os.path.realpath(x) not in excluded)
+
+
+def processor_config(processor):
+    '''Returns the arguments to create a copy of |processor| in a worker process.'''
+    return {
+        'measurement': processor.measurement,
+        'profile_type': processor.profile_type,
+        'quality': processor.quality,
+        'multi_shot': processor.multi_shot,
+        'debug': processor.debug,
+        'decode_cache': processor.decode_cache,
+        'baked_luts': processor.baked_luts,
+        'camera': processor.camera,
+        'strip_rows': processor.strip_rows,
+        'output_sizes': processor.output_sizes,
+        'compression': processor.compression,
+        'compression_level': processor.compression_level,
+        'cache_batch_decodes': processor.cache_batch_decodes,
+        'compression_threads': processor.compression_threads,
+        }
+
+
+# NegativeProcessor of the worker process.
+_processor = None
+
+def _init_worker(config):
+    global _processor
+    _processor = neg_process.NegativeProcessor(**config)
+
+
+def process_frame(raw_file, film_base_rgb, emulsion=None, profile_name=None, exposure_comp=None,
+                  post_correction_gamma=1.0, colorspace=None, scale_down_factor=1, no_crop=False,
+                  processor=None):
+    '''Selects the profile for |raw_file| and develops it. This runs in a worker process
+    unless |processor| is given. Returns a dictionary of the results for reporting.'''
+    processor = processor or _processor
+    start = time.time()
+    profile, p_to_scale, _ = processor.select_profile(raw_file, film_base_rgb, emulsion, profile_name)
+    exp_comp = exposure_comp if exposure_comp else p_to_scale[profile['name']]
+    out_file = processor.export(raw_file, profile, exp_comp, post_correction_gamma,
+                                film_base_rgb, colorspace, scale_down_factor, no_crop)
+    return {
+        'raw_file': raw_file,
+        'profile': profile['name'],
+        'exposure_comp': exp_comp,
+        'out_file': out_file,
+        'time': time.time() - start,
+        }
+
+
+def select_roll_profiles(processor, raw_files, film_base_rgb, emulsion=None, profile_name=None,
+                         exposure_comp=None):
+    '''Selects the profiles of all |raw_files| in one pass, see
+    NegativeProcessor.select_profiles(). Returns the profile name and exposure
+    compensation of each frame, as arguments for process_frame() or decode_frame().
+    If any frame can't be read the profiles are selected frame by frame instead, so
+    only that frame fails.'''
+    if profile_name or not raw_files:
+        return [(profile_name, exposure_comp)] * len(raw_files)
+    start = time.time()
+    try:
+        selections = processor.select_profiles(raw_files, film_base_rgb, emulsion)
+    except Exception as e:
+        if processor.debug:
+            traceback.print_exception(type(e), e, e.__traceback__)
+        print('Cannot select profiles for the roll, selecting for each frame: %s' % e)
+        return [(profile_name, exposure_comp)] * len(raw_files)
+    print('Selected profiles of %d frames in %f seconds.' % (len(raw_files), time.time() - start))
+    return [(profile['name'], exposure_comp if exposure_comp else p_to_scale[profile['name']])
+            for profile, p_to_scale, _ in selections]
+
+
+def process_roll(processor, raw_files, film_base_rgb, jobs=None, **frame_args):
+    '''Develops |raw_files| with |jobs| worker processes, by default one per core.
+    |frame_args| are passed to process_frame(). Profiles are selected for the whole
+    roll before developing. A failed frame doesn't stop the roll. Returns the list of
+    results and the list of (raw_file, error) of failed frames. If |film_base_rgb| is
+    None it is measured from the rebate of the frames.'''
+    if processor.multi_shot:
+        # Each pixel shift capture is 4 files, the first one is passed to neg_process.
+        raw_files = raw_files[::4]
+    if film_base_rgb is None:
+        film_base_rgb = processor.measure_film_base(raw_files, frame_args.get('emulsion'),
+                                                    frame_args.get('profile_name'))
+        if film_base_rgb is None:
+            raise ValueError('No film base found in the rebate of the roll')
+    jobs = jobs or os.cpu_count()
+    results = []
+    failures = []
+    start = time.time()
+    selections = select_roll_profiles(processor, raw_files, film_base_rgb, frame_args.get('emulsion'),
+                                      frame_args.get('profile_name'), frame_args.get('exposure_comp'))
+    print('Processing %d frames with %d workers.' % (len(raw_files), jobs))
+    config = processor_config(processor)
+    if jobs > 1 and not processor.compression_threads:
+        # Share the cores between the workers compressing at the same time.
+        config['compression_threads'] = max(1, (os.cpu_count() or 1) // jobs)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(config,)) as executor:
+        futures = {executor.submit(process_frame, raw_file, film_base_rgb,
+                                   **dict(frame_args, profile_name=profile_name, exposure_comp=exp_comp)): raw_file
+                   for raw_file, (profile_name, exp_comp) in zip(raw_files, selections)}
+        for future in concurrent.futures.as_completed(futures):
+            raw_file = futures[future]
+            done = len(results) + len(failures) + 1
+            try:
+                result = future.result()
+            except Exception as e:
+                if processor.debug:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                failures.append((raw_file, e))
+                print('[%d/%d] %s failed: %s' % (done, len(raw_files), raw_file, e))
+                continue
+            results.append(result)
+            print('[%d/%d] %s -> %s with profile %s, exposure comp %f in %f seconds' % (
+                done, len(raw_files), raw_file, result['out_file'], result['profile'],
+                result['exposure_comp'], result['time']))
+    print('Processed %d frames in %f seconds, %d failed.' % (len(results), time.time() - start, len(failures)))
+    for raw_file, e in failures:
+        print('  Failed %s: %s' % (raw_file, e))
+    return results, failures
+
+
+def decode_frame(processor, raw_file, film_base_rgb, emulsion=None, profile_name=None, exposure_comp=None,
+                 scale_down_factor=1, no_crop=False):
+    '''Selects the profile for |raw_file| and decodes it, at the largest of the output
+    sizes if the processor has output_sizes. Returns the profile, the exposure
+    compensation and the linear image.'''
+    profile, p_to_scale, _ = processor.select_profile(raw_file, film_base_rgb, emulsion, profile_name)
+    exp_comp = exposure_comp if exposure_comp else p_to_scale[profile['name']]
+    linear_img = processor.decode_linear_image(raw_file, processor.decode_scale_down_factor(scale_down_factor),
+                                               no_crop, cache=processor.cache_batch_decodes)
+    return profile, exp_comp, linear_img
+
+
+def render_frame(processor, raw_file, profile, exp_comp, linear_img, film_base_rgb, post_correction_gamma=1.0,
+                 colorspace=None, scale_down_factor=1, no_crop=False, out_dir=None):
+    '''Renders a frame decoded by decode_frame(). Returns the image, the output file and
+    the ICC profile to embed, the same as what bin_out/neg_process would write.'''
+    out_img = processor.render(linear_img, profile, exp_comp, post_correction_gamma, film_base_rgb, colorspace)
+    out_file = processor.neg_process_command(raw_file, profile, exp_comp, post_correction_gamma,
+                                             film_base_rgb, colorspace,
+                                             processor.decode_scale_down_factor(scale_down_factor), no_crop)[1]
+    if out_dir:
+        out_file = os.path.join(out_dir, out_file)
+    return out_img, out_file, processor.output_profile_data(profile, colorspace)
+
+
+def develop_frame(processor, raw_file, film_base_rgb, emulsion=None, profile_name=None, exposure_comp=None,
+                  post_correction_gamma=1.0, colorspace=None, scale_down_factor=1, no_crop=False,
+                  out_dir=None, out_file=None):
+    '''Develops |raw_file| in this process, reusing the profiles and ICC transforms of
+    |processor|. Returns a dictionary of the results with the time of each step.'''
+    start = time.time()
+    profile, exp_comp, linear_img = decode_frame(processor, raw_file, film_base_rgb, emulsion, profile_name,
+                                                 exposure_comp, scale_down_factor, no_crop)
+    decoded = time.time()
+    out_img, default_out_file, icc_profile = render_frame(processor, raw_file, profile, exp_comp, linear_img,
+                                                          film_base_rgb, post_correction_gamma, colorspace,
+                                                          scale_down_factor, no_crop, out_dir)
+    out_file = out_file or default_out_file
+    rendered = time.time()
+    out_file = processor.write_outputs(out_file, out_img, icc_profile, scale_down_factor)
+    return {
+        'raw_file': raw_file,
+        'profile': profile['name'],
+        'exposure_comp': exp_comp,
+        'out_file': out_file,
+        'time': time.time() - start,
+        'decode_time': decoded - start,
+        'render_time': rendered - decoded,
+        'write_time': time.time() - rendered,
+        }
+
+
+def _report_failure(processor, failures, raw_file, e):
+    if processor.debug:
+        traceback.print_exception(type(e), e, e.__traceback__)
+    failures.append((raw_file, e))
+    print('%s failed: %s' % (raw_file, e))
+
+
+def process_roll_pipelined(processor, raw_files, film_base_rgb, queue_size=2, emulsion=None, profile_name=None,
+                           exposure_comp=None, post_correction_gamma=1.0, colorspace=None,
+                           scale_down_factor=1, no_crop=False, out_dir=None):
+    '''Develops |raw_files| in a pipeline of three stages that run at the same time:
+    the next frame is decoded while the current frame is rendered and the output of
+    the previous frame is written. At most |queue_size| frames wait between two stages
+    so the memory used is bounded. Returns the same as process_roll().
+
+    |raw_files| can also be an iterator that yields files as they arrive, see
+    neg_watch.py, in that case pixel shift captures are expected to be grouped by
+    the iterator and profiles are selected frame by frame instead of for the whole
+    roll. Outputs are written to |out_dir| if given.
+
+    If |film_base_rgb| is None it is measured from the rebate of the frames, see
+    NegativeProcessor.measure_film_base(). For an iterator each frame uses the film
+    base combined from the frames so far.'''
+    if isinstance(raw_files, list):
+        if processor.multi_shot:
+            raw_files = raw_files[::4]
+        total = '/%d' % len(raw_files)
+        if film_base_rgb is None:
+            film_base_rgb = processor.measure_film_base(raw_files, emulsion, profile_name)
+            if film_base_rgb is None:
+                raise ValueError('No film base found in the rebate of the roll')
+        selections = dict(zip(raw_files, select_roll_profiles(processor, raw_files, film_base_rgb, emulsion,
+                                                              profile_name, exposure_comp)))
+        print('Processing %d frames in a pipeline.' % len(raw_files))
+    else:
+        total = ''
+        selections = {}
+    results = []
+    failures = []
+    # Frames between the stages, None marks the end of the roll.
+    decoded = queue.Queue(maxsize=queue_size)
+    rendered = queue.Queue(maxsize=queue_size)
+    start = time.time()
+
+    def decode():
+        '''Selects the profile and decodes the RAW file.'''
+        for raw_file in raw_files:
+            frame_start = time.time()
+            frame_profile_name, frame_exposure_comp = selections.get(raw_file, (profile_name, exposure_comp))
+            try:
+                frame_film_base_rgb = film_base_rgb
+                if frame_film_base_rgb is None:
+                    frame_film_base_rgb = processor.measure_film_base([raw_file], emulsion, profile_name)
+                    if frame_film_base_rgb is None:
+                        raise ValueError('No film base found in the rebate of the frames so far')
+                profile, exp_comp, linear_img = decode_frame(processor, raw_file, frame_film_base_rgb, emulsion,
+                                                             frame_profile_name, frame_exposure_comp,
+                                                             scale_down_factor, no_crop)
+            except Exception as e:
+                _report_failure(processor, failures, raw_file, e)
+                continue
+            decoded.put((raw_file, profile, exp_comp, linear_img, frame_film_base_rgb, frame_start))
+        decoded.put(None)
+
+    def render():
+        '''Applies the correction matrix, gamma and ICC transform.'''
+        while True:
+            frame = decoded.get()
+            if frame is None:
+                break
+            raw_file, profile, exp_comp, linear_img, frame_film_base_rgb, frame_start = frame
+            try:
+                out_img, out_file, icc_profile = render_frame(processor, raw_file, profile, exp_comp, linear_img,
+                                                              frame_film_base_rgb, post_correction_gamma, colorspace,
+                                                              scale_down_factor, no_crop, out_dir)
+            except Exception as e:
+                _report_failure(processor, failures, raw_file, e)
+                continue
+            # Release the linear image before waiting for the writer.
+            del linear_img, frame
+            rendered.put((raw_file, profile, exp_comp, out_img, out_file, icc_profile, frame_start))
+        rendered.put(None)
+
+    stages = [threading.Thread(target=decode, daemon=True), threading.Thread(target=render, daemon=True)]
+    for stage in stages:
+        stage.start()
+    # Writing is done on this thread.
+    while True:
+        frame = rendered.get()
+        if frame is None:
+            break
+        raw_file, profile, exp_comp, out_img, out_file, icc_profile, frame_start = frame
+        try:
+            processor.write_outputs(out_file, out_img, icc_profile, scale_down_factor)
+        except Exception as e:
+            _report_failure(processor, failures, raw_file, e)
+            continue
+        results.append({
+            'raw_file': raw_file,
+            'profile': profile['name'],
+            'exposure_comp': exp_comp,
+            'out_file': out_file,
+            'time': time.time() - frame_start,
+            })
+        print('[%d%s] %s -> %s with profile %s, exposure comp %f in %f seconds' % (
+            len(results) + len(failures), total, raw_file, out_file, profile['name'],
+            exp_comp, results[-1]['time']))
+    for stage in stages:
+        stage.join()
+    print('Processed %d frames in %f seconds, %d failed.' % (len(results), time.time() - start, len(failures)))
+    for raw_file, e in failures:
+        print('  Failed %s: %s' % (raw_file, e))
+    return results, failures
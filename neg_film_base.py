@@ -0,0 +1,98 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Measuring the film base from the rebate or the gap between frames captured
+# along with the frame, instead of a separate capture of the film base.
+#
+# Unexposed film is the least dense part of the negative. In the binned RAW (see
+# NegativeProcessor.decode_binned_raw()) the film base is found near the border of
+# the capture as the brightest uniform area with the color of the film base of the
+# profile. The light through sprocket holes or past the film has a different color
+# and is ignored. The measurements of the frames of a roll are combined by
+# RollFilmBase.
+
+import threading
+import cv2
+import numpy as np
+
+# Fraction of the width and height at each side of the capture searched for rebate.
+BORDER = 0.2
+# Maximum difference of G/R and B/R from the film base of the profile, in log10.
+# The film base varies with development so this is loose.
+CHROMA_TOLERANCE = 0.15
+# Maximum difference of log10 brightness between a block and its neighbours.
+UNIFORMITY = 0.02
+# Blocks within this log10 brightness of the brightest candidates are film base.
+BRIGHTNESS_RANGE = 0.05
+# Minimum number of film base blocks for a measurement.
+MIN_BLOCKS = 16
+
+
+def measure_film_base(linear_img, reference_rgb):
+    '''Returns the linear RGB of the film base found in |linear_img|, a small linear
+    image of the whole capture, and the number of pixels it is measured from. Returns
+    None if there's no rebate in the capture. |reference_rgb| is the film base of the
+    profile, only its color is used.'''
+    h, w, _ = linear_img.shape
+    log_img = np.log10(np.maximum(linear_img, 1))
+    border = np.ones((h, w), dtype=bool)
+    border[int(h * BORDER):h - int(h * BORDER), int(w * BORDER):w - int(w * BORDER)] = False
+    log_reference = np.log10(reference_rgb)
+    chroma = log_img[:, :, 1:] - log_img[:, :, :1]
+    film_color = np.max(np.abs(chroma - (log_reference[1:] - log_reference[0])), axis=2) < CHROMA_TOLERANCE
+    brightness = np.mean(log_img, axis=2)
+    kernel = np.ones((3, 3), np.uint8)
+    uniform = (cv2.dilate(brightness, kernel) - cv2.erode(brightness, kernel)) < UNIFORMITY
+    candidates = border & film_color & uniform
+    if np.count_nonzero(candidates) < MIN_BLOCKS:
+        return None
+    # Unexposed film is brighter than any part of the image.
+    selected = candidates & (brightness >= np.percentile(brightness[candidates], 95) - BRIGHTNESS_RANGE)
+    if np.count_nonzero(selected) < MIN_BLOCKS:
+        return None
+    return np.median(linear_img[selected], axis=0), int(np.count_nonzero(selected))
+
+
+class RollFilmBase:
+    '''Combines the film base measured on the frames of a roll as they come. The
+    estimate is the median of the measurements weighted by the number of pixels, so
+    a few frames measured wrong don't change it.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rgbs = []
+        self._weights = []
+
+    def add(self, rgb, weight):
+        with self._lock:
+            self._rgbs.append(list(rgb))
+            self._weights.append(weight)
+
+    def __len__(self):
+        return len(self._rgbs)
+
+    def film_base_rgb(self):
+        '''Returns the film base RGB of the roll so far or None if nothing is measured.'''
+        with self._lock:
+            if not self._rgbs:
+                return None
+            rgbs = np.array(self._rgbs)
+            weights = np.array(self._weights, dtype=np.float64)
+        film_base_rgb = []
+        for c in range(3):
+            order = np.argsort(rgbs[:, c])
+            cumulative = np.cumsum(weights[order])
+            film_base_rgb.append(int(rgbs[order[np.searchsorted(cumulative, cumulative[-1] / 2)], c]))
+        return film_base_rgb
@@ -0,0 +1,484 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Interactive mode of neg_process.py, the film base selector and the preview window
+# with the sliders for profile, exposure compensation and gamma.
+
+import cv2
+import math
+import numpy as np
+import os
+import time
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.widgets as widgets
+import matplotlib.patches as patches
+import neg_process
+import neg_render
+import page_slider
+from pathlib import Path
+
+plt.rcParams.update({'font.size': 7})
+plt.rcParams["figure.figsize"] = (15,10)
+plt.rcParams["image.interpolation"] = 'none'
+
+
+class FilmBaseSelector:
+    def _line_select_callback(self, eclick, erelease):
+        x1, y1 = eclick.xdata, eclick.ydata
+        x2, y2 = erelease.xdata, erelease.ydata
+
+    def show_selector(self, path):
+        film_base_img = cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+        film_base_img = cv2.cvtColor(film_base_img, cv2.COLOR_BGR2RGB)
+        thumb_img = cv2.normalize(film_base_img, None, 0, 255, norm_type=cv2.NORM_MINMAX)
+        
+        fig, ax = plt.subplots(1)
+        plot = ax.imshow(thumb_img)
+        fig.tight_layout()
+        selector = widgets.RectangleSelector(ax, self._line_select_callback,
+                                             useblit=True,
+                                             button=[1, 3],  # don't use middle button
+                                             minspanx=5, minspany=5,
+                                             spancoords='pixels',
+                                             interactive=True)
+        img_h, img_w, _ = thumb_img.shape
+        patch_w = min(img_h, img_w) / 4
+        ax.add_patch(patches.Rectangle(
+                ((img_w - patch_w) / 2, (img_h - patch_w) / 2),
+                patch_w, patch_w, linewidth=1, edgecolor='r', facecolor='none'))
+        plt.show()
+        xmin, xmax, ymin, ymax = selector.extents
+        if xmax > xmin and ymax > ymin + 1:
+            selected_img = film_base_img[int(ymin):int(ymax), int(xmin):int(xmax)]
+            return [int(x) for x in np.mean([selected_img], axis=(0, 1, 2))]
+        return None
+
+
+class BlitManager:
+    '''Redraws a set of animated artists over a cached background of their axes so
+    that updating them doesn't redraw the whole figure. Axes without animated
+    artists (e.g. the widgets) are left untouched.
+    See https://matplotlib.org/stable/tutorials/advanced/blitting.html'''
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self._bg = {}
+        self._artists = []
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self._artists.append(artist)
+        return artist
+
+    def _axes(self):
+        return list(dict.fromkeys(a.axes for a in self._artists))
+
+    def _on_draw(self, event):
+        # Animated artists are excluded from a full draw, so cache the background
+        # and then draw them on top.
+        self._bg = {ax: self.canvas.copy_from_bbox(ax.bbox) for ax in self._axes()}
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for a in self._artists:
+            self.canvas.figure.draw_artist(a)
+
+    def update(self):
+        if not self._bg:
+            # Figure is not drawn yet, artists will be drawn with the first draw.
+            return
+        for ax in self._axes():
+            self.canvas.restore_region(self._bg[ax])
+        self._draw_animated()
+        for ax in self._axes():
+            self.canvas.blit(ax.bbox)
+        self.canvas.flush_events()
+
+
+def select_film_base_rgb(processor, film_base_raw_file):
+    '''Lets the user select the film base from |film_base_raw_file|. Returns the film
+    base RGB normalized to 1s shutter speed or None if nothing is selected.'''
+    film_base_tif = processor.run_neg_process(film_base_raw_file, None, 1.0, 1.0, None, None, 4, True, 'film_base.tif')
+    selected_film_base_rgb = FilmBaseSelector().show_selector(film_base_tif)
+    if not selected_film_base_rgb:
+        return None
+    raw_shutter_speed = processor.raw_shutter_speed(film_base_raw_file)
+    if processor.debug:
+        print('Selected film base shutter speed: %f' % raw_shutter_speed)
+    selected_film_base_rgb = [int(x / raw_shutter_speed) for x in selected_film_base_rgb]
+    print("Selected Film Base RGB: %d %d %d (normalized to 1s shutter speed)" % tuple(selected_film_base_rgb))
+    return selected_film_base_rgb
+
+
+def run(processor, args, profile, p_to_scale, exp_map, exp_comp, selected_film_base_rgb):
+    '''Shows the preview window of |args.raw_file| starting with |profile| and |exp_comp|.
+    |p_to_scale| and |exp_map| are returned by NegativeProcessor.select_profile().
+    The image is exported with the final parameters when the window is closed,
+    returns the output file.'''
+    # Current params.
+    gamma = 1
+    profile_exp = profile['exp']
+
+    # The RAW file is decoded only once in interactive mode. The correction matrix, gamma
+    # and ICC profile are applied in-process for each update.
+    # cv2 reads the image without caring the embedded ICC profile.
+    # Meanwhile imshow() will display the image assuming they have sRGB curves, at least in OSX.
+    # For this reason apply a srgb output profile for correct brightness of the image displayed.
+    PREVIEW_SCALE_DOWN_FACTOR = 4
+    start = time.time()
+    preview_renderer = processor.renderer(
+        processor.decode_linear_image(args.raw_file, PREVIEW_SCALE_DOWN_FACTOR, False), 'srgb', baked=True)
+    # The quarter size decode is a half size decode from LibRaw (no interpolation) reduced by 2. The
+    # draft is reduced by 2 again and takes a quarter of the time to render.
+    preview_renderers = [preview_renderer]
+    if not args.no_progressive_preview:
+        preview_renderers.insert(0, preview_renderer.downscaled(2))
+    print('Decoded preview in %f seconds.' % (time.time() - start))
+
+    fig, ax_img = plt.subplots()
+    fig.tight_layout()
+    print("Zoom into the preview and press 'z' to render the visible region at full size.")
+
+    ax_gamma = fig.add_axes([0.825, 0.30, 0.15, 0.018])
+    ax_exp_comp = fig.add_axes([0.825, 0.35, 0.15, 0.018])
+    ax_profile = fig.add_axes([0.825, 0.40, 0.15, 0.018])
+    ax_density_map = fig.add_axes([0.82, 0.439, 0.15, 0.20])
+    ax_color_bar = fig.add_axes([0.965, 0.439, 0.01, 0.20])
+    ax_lab_hist = fig.add_axes([0.825, 0.68, 0.15, 0.10])
+    ax_l_hist = fig.add_axes([0.825, 0.82, 0.15, 0.10])
+
+    norm = matplotlib.colors.BoundaryNorm(np.linspace(-3, 4, 8), plt.cm.bone.N)
+    ax_density_map.set_title('Density Map')
+    if exp_map is None:
+        # The profile was given so there's no map of the best profile exposure.
+        exp_map = np.zeros((50, 50), dtype=int)
+    im_density_map = ax_density_map.imshow(exp_map, cmap='bone', norm=norm)
+    fig.colorbar(im_density_map, cax=ax_color_bar, orientation='vertical', cmap='bone', norm=norm, ticks=np.arange(-3, 4))
+    def im_density_map_onclick(event):
+        if event.xdata != None and event.ydata != None and event.inaxes == ax_density_map:
+            val = event.inaxes.get_images()[0].get_cursor_data(event)
+            slider_profile.set_val(val)
+    im_density_map.figure.canvas.mpl_connect('button_press_event', im_density_map_onclick)
+
+    slider_exp_comp = widgets.Slider(ax_exp_comp, 'Exp. Comp.', 0, 3, valinit=exp_comp)
+    slider_gamma = widgets.Slider(ax_gamma, 'Gamma', 0.1, 3, valinit=gamma)
+
+    slider_profile = page_slider.PageSlider(ax_profile, 'Profile Exp', min_page=-3, max_page=3, activecolor="orange", valinit=profile_exp)
+
+    fig.subplots_adjust(right=0.80)
+
+    # Artists updated by show_rendered_preview() are created once and updated in place.
+    blit_manager = BlitManager(fig.canvas)
+    im_preview = blit_manager.add_artist(ax_img.imshow(
+        np.zeros(preview_renderer.linear_img.shape, dtype=np.float32), resample=False, filternorm=False))
+
+    AB_HIST_BINS = np.linspace(-128, 128, 51)
+    L_HIST_BINS = np.linspace(0, 100, 51)
+
+    def add_hist_bars(ax, bins, color):
+        bars = ax.bar(bins[:-1], np.zeros(len(bins) - 1), width=np.diff(bins), align='edge', color=color)
+        for bar in bars:
+            blit_manager.add_artist(bar)
+        return bars
+
+    def add_mean_marker(ax, y, color):
+        line = blit_manager.add_artist(ax.axvline(0, color=color, linestyle='dashed', linewidth=1))
+        text = blit_manager.add_artist(ax.text(0, y, '', transform=ax.get_xaxis_transform(), color=color))
+        return line, text
+
+    ax_lab_hist.set_title('a* b* Histogram')
+    ax_lab_hist.set_facecolor("grey")
+    ax_lab_hist.set_xlim([-128, 128])
+    ax_lab_hist.tick_params(axis="y", labelsize=5)
+    a_hist_bars = add_hist_bars(ax_lab_hist, AB_HIST_BINS, 'magenta')
+    b_hist_bars = add_hist_bars(ax_lab_hist, AB_HIST_BINS, 'yellow')
+    a_mean_line, a_mean_text = add_mean_marker(ax_lab_hist, 0.9, 'magenta')
+    b_mean_line, b_mean_text = add_mean_marker(ax_lab_hist, 0.8, 'yellow')
+
+    ax_l_hist.set_title('L* Histogram')
+    ax_l_hist.set_xlim([0, 100])
+    l_hist_bars = add_hist_bars(ax_l_hist, L_HIST_BINS, 'grey')
+    l_mean_line, l_mean_text = add_mean_marker(ax_l_hist, 0.9, 'black')
+    l_mean_text.set_color('red')
+
+    def update_hist_bars(ax, bars_and_counts):
+        '''Sets heights of the bars and returns True if the y-axis has to be rescaled,
+        which needs a full redraw of the figure.'''
+        max_count = 0
+        for bars, counts in bars_and_counts:
+            for bar, count in zip(bars, counts):
+                bar.set_height(count)
+            max_count = max(max_count, counts.max())
+        _, top = ax.get_ylim()
+        if max_count > 0 and (max_count > top or max_count < top / 2):
+            ax.set_ylim(0, max_count * 1.1)
+            return True
+        return False
+
+    def update_mean_marker(line, text, mean, color=None):
+        line.set_xdata([mean, mean])
+        text.set_x(mean + 3)
+        text.set_text(str(round(mean, 2)))
+        if color:
+            line.set_color(color)
+
+    lab_histogram = neg_render.LabHistogram(AB_HIST_BINS, L_HIST_BINS)
+    preview_cache = neg_render.PreviewCache(args.preview_cache_mb * 1024 * 1024)
+
+    def preview_cache_key(params):
+        profile, exp_comp, gamma = params
+        return (args.raw_file, profile['name'], args.profile_type, exp_comp, gamma, tuple(selected_film_base_rgb))
+
+    def render_with_stats(renderer, params, cancelled):
+        '''Renders the preview and its Lab statistics with |renderer|.'''
+        profile, exp_comp, gamma = params
+        start = time.time()
+        out_img = renderer.render(profile['matrix'], processor.profile_icc_path(profile), exp_comp, gamma,
+                                  profile['film_base_rgb'], selected_film_base_rgb, cancelled)
+        if out_img is None:
+            return None
+        out_img = out_img.astype(np.float32) / 65535
+        end_neg_process = time.time()
+        if cancelled():
+            return None
+
+        # TODO: Exclude border.
+        lab_stats = lab_histogram.compute(out_img, args.lab_stats_stride)
+        return out_img, lab_stats, end_neg_process - start, time.time() - start
+
+    def render_preview(params, level, cancelled):
+        '''Renders the preview, this runs on the render thread.
+        |level| selects the renderer from the draft to the full preview.'''
+        full_level = len(preview_renderers) - 1
+        cached = preview_cache.get(preview_cache_key(params))
+        if cached is not None:
+            # Show the full preview right away, there's nothing to refine.
+            if level > 0:
+                return None
+            prefetch_scheduler.submit(params)
+            return cached
+        rendered = render_with_stats(preview_renderers[level], params, cancelled)
+        if rendered is not None and level == full_level:
+            preview_cache.put(preview_cache_key(params), rendered)
+            if not cancelled():
+                prefetch_scheduler.submit(params)
+        return rendered
+
+    def neighbour_profile_name(profile, exp):
+        return profile['emulsion'] + ('' if exp == 0 else '%+1d' % exp)
+
+    # Previews of the profiles next to the current one are rendered into the preview cache
+    # once the current preview is done, so that stepping through the profiles is instant.
+    prefetch_renderer = neg_render.PreviewRenderer(preview_renderer.linear_img, 'srgb', baked=True)
+
+    def prefetch_neighbours(params, level, cancelled):
+        '''Renders the neighbour profiles into the preview cache, this runs on the prefetch thread.'''
+        if params is None:
+            return None
+        profile, _, gamma = params
+        for exp in [profile['exp'] + 1, profile['exp'] - 1]:
+            neighbour = processor.read_profile_info(neighbour_profile_name(profile, exp))
+            if cancelled() or not neighbour or neighbour['name'] not in p_to_scale:
+                continue
+            # Same exposure as update_profile() would choose.
+            neighbour_params = (neighbour, p_to_scale[neighbour['name']], gamma)
+            if preview_cache.get(preview_cache_key(neighbour_params)) is not None:
+                continue
+            rendered = render_with_stats(prefetch_renderer, neighbour_params, cancelled)
+            if rendered is not None:
+                preview_cache.put(preview_cache_key(neighbour_params), rendered)
+                if args.debug:
+                    print('Prefetched profile %s' % neighbour['name'])
+        return None
+
+    prefetch_scheduler = neg_render.RenderScheduler(prefetch_neighbours, debounce=0.3)
+
+    def show_rendered_preview():
+        '''Shows the latest finished render, this is polled from the UI thread.'''
+        rendered = render_scheduler.poll()
+        if rendered is None:
+            return
+        start = time.time()
+        _, (out_img, lab_stats, process_time, stats_time) = rendered
+        # The image can be shown as-is because it's in sRGB colorspace.
+        im_preview.set_data(out_img)
+
+        a_color = 'magenta' if lab_stats['a_mean'] >= 0 else 'green'
+        b_color = 'yellow' if lab_stats['b_mean'] >= 0 else 'blue'
+        for bar in a_hist_bars:
+            bar.set_color(a_color)
+        for bar in b_hist_bars:
+            bar.set_color(b_color)
+        rescaled = update_hist_bars(ax_lab_hist, [(a_hist_bars, lab_stats['a_hist']),
+                                                  (b_hist_bars, lab_stats['b_hist'])])
+        update_mean_marker(a_mean_line, a_mean_text, lab_stats['a_mean'], a_color)
+        update_mean_marker(b_mean_line, b_mean_text, lab_stats['b_mean'], b_color)
+
+        rescaled |= update_hist_bars(ax_l_hist, [(l_hist_bars, lab_stats['l_hist'])])
+        update_mean_marker(l_mean_line, l_mean_text, lab_stats['l_mean'])
+        if rescaled:
+            # Ticks of the histogram axes have changed.
+            fig.canvas.draw_idle()
+        else:
+            blit_manager.update()
+        print('Process time %f Show time %f' % (process_time, stats_time + time.time() - start))
+
+    render_scheduler = neg_render.RenderScheduler(render_preview, levels=len(preview_renderers))
+    render_timer = fig.canvas.new_timer(interval=15)
+    render_timer.add_callback(show_rendered_preview)
+    render_timer.start()
+
+    # Zoom mode renders the visible part of the preview at full resolution. Only that region
+    # of the RAW file is decoded.
+    zoom_region = None
+    zoom_renderer = None
+    im_zoom = blit_manager.add_artist(ax_img.imshow(
+        np.zeros((1, 1, 3), dtype=np.float32), resample=False, filternorm=False, visible=False))
+
+    def visible_region():
+        '''Returns the (left, top, width, height) in full size pixels of the visible part of
+        the preview. The area is limited to the number of pixels of the preview.'''
+        h, w, _ = preview_renderer.linear_img.shape
+        x0, x1 = np.clip(sorted(ax_img.get_xlim()), -0.5, w - 0.5) + 0.5
+        y0, y1 = np.clip(sorted(ax_img.get_ylim()), -0.5, h - 0.5) + 0.5
+        f = PREVIEW_SCALE_DOWN_FACTOR
+        shrink = min(1, math.sqrt(w * h / ((x1 - x0) * (y1 - y0) * f * f)))
+        width = (x1 - x0) * f * shrink
+        height = (y1 - y0) * f * shrink
+        left = (x0 + x1) / 2 * f - width / 2
+        top = (y0 + y1) / 2 * f - height / 2
+        # Keep the Bayer pattern aligned.
+        return tuple(int(x) & ~1 for x in (left, top, width, height))
+
+    def render_zoom(params, level, cancelled):
+        '''Renders the zoom region, this runs on the zoom render thread.'''
+        nonlocal zoom_renderer
+        profile, exp_comp, gamma, region = params
+        if zoom_renderer is None or zoom_renderer[0] != region:
+            zoom_renderer = (region, neg_render.PreviewRenderer(
+                processor.decode_linear_image(args.raw_file, 1, False, region), 'srgb', baked=True))
+        out_img = zoom_renderer[1].render(profile['matrix'], processor.profile_icc_path(profile), exp_comp, gamma,
+                                          profile['film_base_rgb'], selected_film_base_rgb, cancelled)
+        if out_img is None:
+            return None
+        return region, out_img.astype(np.float32) / 65535
+
+    def show_rendered_zoom():
+        '''Shows the latest finished zoom render, this is polled from the UI thread.'''
+        rendered = zoom_scheduler.poll()
+        if rendered is None:
+            return
+        _, (region, out_img) = rendered
+        if region != zoom_region:
+            return
+        left, top, width, height = region
+        f = PREVIEW_SCALE_DOWN_FACTOR
+        im_zoom.set_data(out_img)
+        im_zoom.set_extent((left / f - 0.5, (left + width) / f - 0.5, (top + height) / f - 0.5, top / f - 0.5))
+        im_zoom.set_visible(True)
+        blit_manager.update()
+
+    def toggle_zoom(event):
+        nonlocal zoom_region
+        if event.key != 'z':
+            return
+        if zoom_region:
+            zoom_region = None
+            im_zoom.set_visible(False)
+            blit_manager.update()
+            return
+        if args.multi_shot:
+            print('Zoom is not supported in multi-shot mode.')
+            return
+        zoom_region = visible_region()
+        print('Rendering region %d %d %dx%d at full size.' % zoom_region)
+        schedule_render()
+
+    zoom_scheduler = neg_render.RenderScheduler(render_zoom)
+    render_timer.add_callback(show_rendered_zoom)
+    fig.canvas.mpl_connect('key_press_event', toggle_zoom)
+
+    def export_command(params):
+        profile, exp_comp, gamma = params
+        return processor.neg_process_command(args.raw_file, profile, exp_comp, gamma,
+                                             selected_film_base_rgb, args.colorspace,
+                                             2 if args.half_size else (4 if args.quarter_size else 1), args.no_crop,
+                                             speculative_out_file)[0]
+
+    pos_out_file = Path(args.raw_file).stem + '.pos.tif'
+    speculative_out_file = Path(args.raw_file).stem + '.pos.speculative.tif'
+    # The speculative export runs bin_out/neg_process, which can't write what export_streaming() writes.
+    speculative_export = None
+    if not processor.streaming:
+        speculative_export = neg_process.SpeculativeExport(export_command, speculative_out_file,
+                                                           debug=args.debug)
+
+    def schedule_render():
+        params = (profile, exp_comp, gamma)
+        # Stop prefetching until the new preview is rendered.
+        prefetch_scheduler.submit(None)
+        render_scheduler.submit(params)
+        if zoom_region:
+            zoom_scheduler.submit(params + (zoom_region,))
+        if speculative_export:
+            speculative_export.update(params)
+
+    def update_exp_comp(val):
+        nonlocal exp_comp
+        exp_comp = val
+        schedule_render()
+
+    def update_gamma(val):
+        nonlocal gamma
+        gamma = val
+        schedule_render()
+
+    def update_profile(val):
+        nonlocal profile
+        nonlocal exp_comp
+        exp = int(val)
+        new_profile = processor.read_profile_info(neighbour_profile_name(profile, exp))
+        if not new_profile or new_profile['name'] == profile['name'] or new_profile['name'] not in p_to_scale:
+            return
+        profile = new_profile
+        exp_comp = p_to_scale[profile['name']]
+        # Move the slider without calling update_exp_comp(), only one render is needed.
+        slider_exp_comp.eventson = False
+        slider_exp_comp.set_val(exp_comp)
+        slider_exp_comp.eventson = True
+        schedule_render()
+
+    slider_exp_comp.on_changed(update_exp_comp)
+    slider_gamma.on_changed(update_gamma)
+    slider_profile.on_changed(update_profile)
+
+    schedule_render()
+    plt.show()
+
+    print('Gamma %f' % gamma)
+    print('Exposure comp %f' % exp_comp)
+    print('Profile used %s' % profile['name'])
+
+    if speculative_export and speculative_export.finish((profile, exp_comp, gamma)):
+        # The export in the background used the final parameters.
+        os.replace(speculative_out_file, pos_out_file)
+        out_file = pos_out_file
+    else:
+        out_file = processor.export(args.raw_file, profile, exp_comp, gamma,
+                                    selected_film_base_rgb, args.colorspace, 2 if args.half_size else (4 if args.quarter_size else 1), args.no_crop,
+                                    pos_out_file)
+    return out_file
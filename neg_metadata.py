@@ -0,0 +1,152 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Metadata of RAW files read by bin_out/raw_info: shutter speed, ISO, image size
+# and, for film base captures, the center-weight average RGB.
+#
+# The metadata of all RAW files in a directory is kept in one index file in
+# CACHE_DIR, keyed by the file name and valid as long as the size and modification
+# time of the file don't change. Missing entries of many files are read with one
+# raw_info invocation.
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+from neg_render import CACHE_DIR, atomic_write
+
+# Version of the index file, an index of another version is read again from the files.
+INDEX_VERSION = 1
+
+# Fields in the output of raw_info by the comment at the end of the line.
+_FIELDS = {
+    'Shutter speed': 'shutter_speed',
+    'ISO speed': 'iso',
+    'Image size': 'size',
+    'Center-weight average RGB': 'center_rgb',
+    'Center-weight RGB stddev': 'center_stddev',
+    }
+
+
+def parse_raw_info(output):
+    '''Parses the output of raw_info -f. Returns the metadata by file name.'''
+    metadata = {}
+    entry = None
+    for line in output.split('\n'):
+        if ' # ' not in line:
+            continue
+        values, label = line.rsplit(' # ', 1)
+        if label == 'File':
+            entry = metadata.setdefault(values, {})
+        elif entry is not None and label in _FIELDS:
+            values = list(map(float, values.split(' ')))
+            if label == 'Image size':
+                entry['width'], entry['height'] = map(int, values)
+            elif label == 'Center-weight average RGB':
+                entry['center_rgb'] = list(map(int, values))
+            elif len(values) == 1:
+                entry[_FIELDS[label]] = values[0]
+            else:
+                entry[_FIELDS[label]] = values
+    return metadata
+
+
+class RawMetadataStore:
+    '''Metadata of the RAW files in |directory|, stored in one index file.'''
+
+    def __init__(self, directory, raw_info, index_file=None):
+        self.directory = os.path.realpath(directory)
+        self.raw_info = raw_info
+        self.index_file = index_file or os.path.join(
+            CACHE_DIR, 'raw_info', '%s.json' % hashlib.sha1(self.directory.encode()).hexdigest()[:16])
+        self._lock = threading.Lock()
+        self._entries = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return index.get('entries', {}) if index.get('version') == INDEX_VERSION else {}
+
+    def _save(self, updated):
+        # Merge with entries written by other processes since the index was read.
+        entries = self._read_index()
+        entries.update(updated)
+        with atomic_write(self.index_file, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'directory': self.directory, 'entries': entries},
+                      f, separators=(',', ':'))
+        self._entries = entries
+
+    def metadata(self, raw_files, center_weight=False):
+        '''Returns the metadata of |raw_files|, a list of dictionaries. The files
+        without a valid entry are read with one raw_info invocation. If |center_weight|
+        is set the center-weight average is also read, this is much slower since the
+        center of the image is decoded.'''
+        with self._lock:
+            stats = {}
+            for raw_file in raw_files:
+                st = os.stat(raw_file)
+                stats[os.path.basename(raw_file)] = [st.st_size, st.st_mtime_ns]
+            stale = self._stale(raw_files, stats, center_weight)
+            if stale:
+                # Another process might have read them.
+                self._entries = self._read_index()
+                stale = self._stale(raw_files, stats, center_weight)
+            if stale:
+                args = [self.raw_info, '-f', '-s', '-i', '-d'] + (['-w'] if center_weight else []) + stale
+                result = subprocess.run(args, stdout=subprocess.PIPE)
+                output = parse_raw_info(result.stdout.decode(sys.stdout.encoding))
+                updated = {}
+                for raw_file in stale:
+                    if raw_file not in output:
+                        raise subprocess.CalledProcessError(result.returncode, args)
+                    name = os.path.basename(raw_file)
+                    updated[name] = dict(output[raw_file], stat=stats[name])
+                self._save(updated)
+            return [dict(self._entries[os.path.basename(x)]) for x in raw_files]
+
+    def _stale(self, raw_files, stats, center_weight):
+        '''Returns the files of |raw_files| without a valid entry, without duplicates.'''
+        stale = {}
+        for raw_file in raw_files:
+            name = os.path.basename(raw_file)
+            entry = self._entries.get(name)
+            if not entry or entry['stat'] != stats[name] or (center_weight and 'center_rgb' not in entry):
+                stale[name] = raw_file
+        return list(stale.values())
+
+
+# Stores loaded by this process by directory.
+_stores = {}
+_stores_lock = threading.Lock()
+
+def raw_metadata(raw_files, raw_info, center_weight=False):
+    '''Returns the metadata of |raw_files|, which can be in different directories.
+    See RawMetadataStore.metadata().'''
+    by_directory = {}
+    for raw_file in raw_files:
+        by_directory.setdefault(os.path.realpath(os.path.dirname(os.path.abspath(raw_file))), []).append(raw_file)
+    metadata = {}
+    for directory, files in by_directory.items():
+        with _stores_lock:
+            if directory not in _stores:
+                _stores[directory] = RawMetadataStore(directory, raw_info)
+            store = _stores[directory]
+        metadata.update(zip(files, store.metadata(files, center_weight)))
+    return [metadata[x] for x in raw_files]
@@ -13,10 +13,13 @@
 // You should have received a copy of the GNU General Public License
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+#include <errno.h>
 #include <math.h>
 #include <stdio.h>
+#include <stdint.h>
 #include <string.h>
 #include <time.h>
+#include <unistd.h>
 #include <lcms2.h>
 
 #include <algorithm>
@@ -59,7 +62,12 @@ void debug_pixel(LibRaw* proc, int row, int col) {
 //
 // When |crop| is false, the entire RAW file is used, disregarding aspect ratio
 // and cropbox specified in the RAW metadata.
-LibRaw* load_raw(const std::string& fn, bool debayer, bool half_size, int qual, bool crop) {
+//
+// If |region| is not empty it is the left, top, width and height of the area to
+// process, in pixels of the full size image (after cropping if |crop| is true).
+// Pixels outside the region are not processed at all.
+LibRaw* load_raw(const std::string& fn, bool debayer, bool half_size, int qual, bool crop,
+                 const std::vector<int>& region = std::vector<int>()) {
   int ret;
   LibRaw* proc = new LibRaw();
 
@@ -102,22 +110,34 @@ LibRaw* load_raw(const std::string& fn, bool debayer, bool half_size, int qual,
     proc->imgdata.params.user_mul[1] = 1;
     proc->imgdata.params.user_mul[2] = 1;
     proc->imgdata.params.user_mul[3] = 1;
+    unsigned left = 0, top = 0;
     if (crop &&
         (proc->imgdata.sizes.raw_inset_crops[0].cleft || proc->imgdata.sizes.raw_inset_crops[0].ctop)) {
-      proc->imgdata.params.cropbox[0] = proc->imgdata.sizes.raw_inset_crops[0].cleft;
-      proc->imgdata.params.cropbox[1] = proc->imgdata.sizes.raw_inset_crops[0].ctop;
+      proc->imgdata.params.cropbox[0] = left = proc->imgdata.sizes.raw_inset_crops[0].cleft;
+      proc->imgdata.params.cropbox[1] = top = proc->imgdata.sizes.raw_inset_crops[0].ctop;
       proc->imgdata.params.cropbox[2] = proc->imgdata.sizes.raw_inset_crops[0].cwidth;
       proc->imgdata.params.cropbox[3] = proc->imgdata.sizes.raw_inset_crops[0].cheight;
     }
+    if (region.size() == 4) {
+      printf("Processing region: %d %d %dx%d\n", region[0], region[1], region[2], region[3]);
+      proc->imgdata.params.cropbox[0] = left + region[0];
+      proc->imgdata.params.cropbox[1] = top + region[1];
+      proc->imgdata.params.cropbox[2] = region[2];
+      proc->imgdata.params.cropbox[3] = region[3];
+    }
     proc->dcraw_process();
   }
   printf("Processed image size: %dx%d\n", proc->imgdata.sizes.iwidth, proc->imgdata.sizes.iheight);
   return proc;
 }
 
-// Merge 4 RAW files from pixel-shift captures using Sony camera.
-LibRaw* merge_pixel_shift_raw(LibRaw *proc[4]) {
-  printf("Merging 4 images...\n");
+// Merge RAW files from pixel-shift captures using Sony camera.
+//
+// |shot| is the |mi|-th of the 4 captures and is merged into |base|, the first
+// capture. Captures are merged one by one in order so that only two images are in
+// memory at the same time. The first capture is merged into itself.
+void merge_pixel_shift_shot(LibRaw* base, LibRaw* shot, int mi) {
+  printf("Merging image %d...\n", mi + 1);
 
   int movements[4][2] = {
     // x, y movements
@@ -127,43 +147,31 @@ LibRaw* merge_pixel_shift_raw(LibRaw *proc[4]) {
     {-1, 0},
   };
 
-#define P(n, r, c) proc[n]->imgdata.image[(r) * proc[n]->imgdata.sizes.iwidth + (c)]
-#define FOR_PIXEL for (int r = 0; r < proc[mi]->imgdata.sizes.iheight - 1; ++r) \
-    for (int c = 1; c < proc[mi]->imgdata.sizes.iwidth; ++c)
-
-  for (int mi = 0; mi < 2; ++mi) {
-    int dc = movements[mi][0];
-    int dr = movements[mi][1];
+#define P(p, r, c) p->imgdata.image[(r) * p->imgdata.sizes.iwidth + (c)]
+#define FOR_PIXEL for (int r = 0; r < shot->imgdata.sizes.iheight - 1; ++r) \
+    for (int c = 1; c < shot->imgdata.sizes.iwidth; ++c)
 
+  int dc = movements[mi][0];
+  int dr = movements[mi][1];
+  if (mi < 2) {
     FOR_PIXEL {
-      int col = proc[mi]->COLOR(r, c);
+      int col = shot->COLOR(r, c);
       if (col & 1)
-        P(0, r+dr, c+dc)[1] = P(mi, r, c)[col];
+        P(base, r+dr, c+dc)[1] = P(shot, r, c)[col];
       else
-        P(0, r+dr, c+dc)[col] = P(mi, r, c)[col];
+        P(base, r+dr, c+dc)[col] = P(shot, r, c)[col];
     }
-    if (mi > 0) {
-      proc[mi]->recycle();
-      delete proc[mi];
-    }
-  }
-
-  for (int mi = 2; mi < 4; ++mi) {
-    int dc = movements[mi][0];
-    int dr = movements[mi][1];
-
+  } else {
     FOR_PIXEL {
-      int col = proc[mi]->COLOR(r, c);
+      int col = shot->COLOR(r, c);
       if (col & 1)
-        P(0, r+dr, c+dc)[1] = (P(mi, r, c)[col] + P(0, r+dr, c+dc)[1]) / 2;
+        P(base, r+dr, c+dc)[1] = (P(shot, r, c)[col] + P(base, r+dr, c+dc)[1]) / 2;
       else
-        P(0, r+dr, c+dc)[col] = P(mi, r, c)[col];
+        P(base, r+dr, c+dc)[col] = P(shot, r, c)[col];
     }
-    proc[mi]->recycle();
-    delete proc[mi];
   }
-  proc[0]->imgdata.idata.colors = 3;
-  return proc[0];
+  if (mi == 3)
+    base->imgdata.idata.colors = 3;
 }
 
 template <class T>
@@ -328,39 +336,10 @@ int apply_profile(ushort (*image)[4], ushort width, ushort height,
   return 0;
 }
 
-int write_tiff(LibRaw* proc, const std::string& attach_profile, const std::string& output, bool half_size) {
-  unsigned* output_profile = NULL;
-  unsigned profile_size = 0;
-  if (!attach_profile.empty()) {
-    // If the profile to attach is not the psuedo "srgb" profile, the profile will be attached to the TIFF.
-    // This is a hack to force LibRaw write the ICC profile in the TIFF without conversion.
-    printf("Attaching profile: %s\n", attach_profile.c_str());
-    if (attach_profile == "srgb") {
-      output_profile = reinterpret_cast<unsigned int*>(sRGB_elle_V2_srgbtrc_icc);
-      profile_size = sRGB_elle_V2_srgbtrc_icc_len;
-    } else if (attach_profile == "srgb-g10") {
-      output_profile = reinterpret_cast<unsigned int*>(sRGB_elle_V2_g10_icc);
-      profile_size = sRGB_elle_V2_g10_icc_len;
-    } else {
-      if (read_profile(attach_profile, &output_profile, &profile_size)) {
-        return -1;
-      }
-    }
-  }
-
+// Writes the rows of the image as 16-bit RGB. If |half_size| is set the image is reduced by 2.
+void write_rows(LibRaw* proc, FILE* fp, bool half_size) {
   const unsigned height = proc->imgdata.sizes.iheight;
   const unsigned width = proc->imgdata.sizes.iwidth;
-  struct tiff_hdr header;
-  if (half_size) {
-    tiff_head(proc, &header, profile_size, width / 2, height / 2);
-  } else {
-    tiff_head(proc, &header, profile_size);
-  }
-  auto* fp = fopen(output.c_str(), "w+");
-  fwrite(&header, sizeof(header), 1, fp);
-  if (profile_size) {
-    fwrite(output_profile, profile_size, 1, fp);
-  }
   const unsigned output_width = half_size ? width / 2 : width;
   ushort row_buf[output_width * 3];
   for (unsigned row = 0; row < height; ++row) {
@@ -394,6 +373,112 @@ int write_tiff(LibRaw* proc, const std::string& attach_profile, const std::strin
       fwrite(row_buf, 3 * 2, width, fp);
     }
   }
+}
+
+// Header of the raw output written to stdout with "-o -", followed by
+// width * height * 3 uint16 values in RGB order. All fields are in host byte order.
+struct raw_hdr {
+  char magic[4];  // "NRGB"
+  uint32_t width;
+  uint32_t height;
+  uint32_t channels;
+};
+
+int write_raw(LibRaw* proc, FILE* fp, bool half_size) {
+  const unsigned height = proc->imgdata.sizes.iheight;
+  const unsigned width = proc->imgdata.sizes.iwidth;
+  struct raw_hdr header = {{'N', 'R', 'G', 'B'},
+                           half_size ? width / 2 : width,
+                           half_size ? height / 2 : height,
+                           3};
+  fwrite(&header, sizeof(header), 1, fp);
+  write_rows(proc, fp, half_size);
+  fclose(fp);
+  return 0;
+}
+
+// Writes the raw output of the unpacked, not processed, Bayer image of |proc|
+// averaged in blocks of |bin| x |bin| pixels for each color, the two greens are
+// averaged together. The black level is subtracted but the values are not scaled,
+// the same as load_raw() gives. The entire sensor area is used, no cropping.
+//
+// This is much faster and smaller than any debayered output and is good enough
+// for measuring the transmittance of a frame, e.g. to select the profile.
+int write_binned_raw(LibRaw* proc, FILE* fp, int bin) {
+  const ushort* raw_image = proc->imgdata.rawdata.raw_image;
+  if (!raw_image || bin < 2) {
+    fprintf(stderr, "Binning needs a Bayer RAW file and a bin size of at least 2.\n");
+    return 1;
+  }
+  const auto& sizes = proc->imgdata.sizes;
+  const auto& color = proc->imgdata.color;
+  const unsigned width = sizes.width / bin;
+  const unsigned height = sizes.height / bin;
+  const unsigned raw_pitch = sizes.raw_pitch / 2;
+  struct raw_hdr header = {{'N', 'R', 'G', 'B'}, width, height, 3};
+  fwrite(&header, sizeof(header), 1, fp);
+
+  std::vector<uint64_t> sums(width * 3);
+  std::vector<uint32_t> counts(width * 3);
+  std::vector<ushort> row_buf(width * 3);
+  for (unsigned y = 0; y < height; ++y) {
+    std::fill(sums.begin(), sums.end(), 0);
+    std::fill(counts.begin(), counts.end(), 0);
+    for (unsigned row = y * bin; row < (y + 1) * bin; ++row) {
+      const ushort* raw_row = raw_image + (row + sizes.top_margin) * raw_pitch + sizes.left_margin;
+      for (unsigned col = 0; col < width * bin; ++col) {
+        int c = proc->COLOR(row, col);
+        int black = color.black + color.cblack[c];
+        if (color.cblack[4] && color.cblack[5])
+          black += color.cblack[6 + (row % color.cblack[4]) * color.cblack[5] + col % color.cblack[5]];
+        // Second green is averaged with the first one.
+        unsigned i = col / bin * 3 + ((c & 1) ? 1 : c);
+        sums[i] += std::max(raw_row[col] - black, 0);
+        ++counts[i];
+      }
+    }
+    for (unsigned i = 0; i < width * 3; ++i) {
+      row_buf[i] = counts[i] ? (sums[i] + counts[i] / 2) / counts[i] : 0;
+    }
+    fwrite(row_buf.data(), 3 * 2, width, fp);
+  }
+  return 0;
+}
+
+int write_tiff(LibRaw* proc, const std::string& attach_profile, const std::string& output, bool half_size) {
+  unsigned* output_profile = NULL;
+  unsigned profile_size = 0;
+  if (!attach_profile.empty()) {
+    // If the profile to attach is not the psuedo "srgb" profile, the profile will be attached to the TIFF.
+    // This is a hack to force LibRaw write the ICC profile in the TIFF without conversion.
+    printf("Attaching profile: %s\n", attach_profile.c_str());
+    if (attach_profile == "srgb") {
+      output_profile = reinterpret_cast<unsigned int*>(sRGB_elle_V2_srgbtrc_icc);
+      profile_size = sRGB_elle_V2_srgbtrc_icc_len;
+    } else if (attach_profile == "srgb-g10") {
+      output_profile = reinterpret_cast<unsigned int*>(sRGB_elle_V2_g10_icc);
+      profile_size = sRGB_elle_V2_g10_icc_len;
+    } else {
+      if (read_profile(attach_profile, &output_profile, &profile_size)) {
+        return -1;
+      }
+    }
+  }
+
+  const unsigned height = proc->imgdata.sizes.iheight;
+  const unsigned width = proc->imgdata.sizes.iwidth;
+  struct tiff_hdr header;
+  if (half_size) {
+    tiff_head(proc, &header, profile_size, width / 2, height / 2);
+  } else {
+    tiff_head(proc, &header, profile_size);
+  }
+  auto* fp = fopen(output.c_str(), "w+");
+  fwrite(&header, sizeof(header), 1, fp);
+  if (profile_size) {
+    fwrite(output_profile, profile_size, 1, fp);
+  }
+  write_rows(proc, fp, half_size);
   fclose(fp);
   return 0;
 }
@@ -449,13 +534,22 @@ int main(int ac, char *av[]) {
     .nargs(3)
     .default_value(std::vector<int>{1, 1, 1})
     .scan<'i', int>();
+  parser.add_argument("--region")
+    .help("'left top width height' of the region to process, in pixels of the full size image. Not used in pixel-shift mode.")
+    .nargs(4)
+    .scan<'i', int>();
+  parser.add_argument("--bin")
+    .help("Only write the Bayer channels averaged in blocks of this size, without debayer, correction or"
+          " cropping. Only the first file is read in pixel-shift mode.")
+    .scan<'i', int>();
   parser.add_argument("-p", "--film_profile")
     .help("ICC Profile that applies to the corrected RGB values (See -r -g and -b flags). Consider this as the input ICC profile.");
   parser.add_argument("-P", "--colorspace")
     .help("srgb, srgb-g10 or [ICC profile path]. If specified the corrected RGB will be converted using this as the output profile.");
   parser.add_argument("-o", "--output")
     .required()
-    .help("Output file location.");
+    .help("Output file location. With '-' the image is written to stdout as a raw_hdr followed by"
+          " the RGB16 pixels and the log goes to stderr.");
   parser.add_argument("raw_files").nargs(1, 4);
 
   try {
@@ -466,29 +560,67 @@ int main(int ac, char *av[]) {
     return 1;
   }
 
+  const auto output = parser.get<std::string>("--output");
+  FILE* raw_out = NULL;
+  if (output == "-") {
+    // Keep stdout for the pixels and send everything printed to stderr.
+    fflush(stdout);
+    raw_out = fdopen(dup(STDOUT_FILENO), "wb");
+    dup2(STDERR_FILENO, STDOUT_FILENO);
+  }
+
   const auto files = parser.get<std::vector<std::string>>("raw_files");
   auto r_coeff = parser.get<std::vector<float>>("--r_coeff");
   auto g_coeff = parser.get<std::vector<float>>("--g_coeff");
   auto b_coeff = parser.get<std::vector<float>>("--b_coeff");
   float global_exposure_comp = parser.get<float>("--exposure_comp");
 
+  if (parser.is_used("--bin")) {
+    // Only unpacked, processing the image is not needed.
+    LibRaw binned_proc;
+    int ret;
+    printf("Loading RAW file %s\n", files[0].c_str());
+    if ((ret = binned_proc.open_file(files[0].c_str())) != LIBRAW_SUCCESS ||
+        (ret = binned_proc.unpack()) != LIBRAW_SUCCESS) {
+      fprintf(stderr, "Cannot load %s: %s\n", files[0].c_str(), libraw_strerror(ret));
+      return 1;
+    }
+    auto* fp = raw_out ? raw_out : fopen(output.c_str(), "wb");
+    if (!fp) {
+      fprintf(stderr, "Cannot open %s for writing: %s\n", output.c_str(), strerror(errno));
+      return 1;
+    }
+    printf("Writing %dx%d binned RAW\n", parser.get<int>("--bin"), parser.get<int>("--bin"));
+    ret = write_binned_raw(&binned_proc, fp, parser.get<int>("--bin"));
+    fclose(fp);
+    return ret;
+  }
+
   LibRaw *proc;
   if (files.size() == 4) {
-    LibRaw *four_proc[4];
     for (int i = 0; i < 4; ++i) {
-      four_proc[i] = load_raw(
+      LibRaw* shot = load_raw(
                          files[i], false, false,
                          /* Quality doesn't matter because no interpolation. */
                          0,
                          /* Don't crop since it might mess up pixel-shift merging. */
                          false);
+      if (!shot)
+        return 1;
+      if (i == 0)
+        proc = shot;
+      merge_pixel_shift_shot(proc, shot, i);
+      if (i > 0) {
+        shot->recycle();
+        delete shot;
+      }
     }
-    proc = merge_pixel_shift_raw(four_proc);
   } else {
     proc = load_raw(files[0], true,
                     parser.get<bool>("--half_size") || parser.get<bool>("--quarter_size"),
                     parser.get<int>("--quality"),
-                    !parser.get<bool>("--no_crop"));
+                    !parser.get<bool>("--no_crop"),
+                    parser.is_used("--region") ? parser.get<std::vector<int>>("--region") : std::vector<int>());
   }
   printf("ISO Speed: %f\n", proc->imgdata.other.iso_speed);
   printf("Shutter Speed: %f\n", proc->imgdata.other.shutter);
@@ -544,9 +676,12 @@ int main(int ac, char *av[]) {
     attach_profile = parser.get<std::string>("--film_profile");
   }
 
-  const auto output = parser.get<std::string>("--output");
+  // Multi-shot mode always gets the full size.
+  const bool half_size = parser.get<bool>("--quarter_size") && files.size() == 1;
+  if (raw_out) {
+    printf("Writing raw RGB16 to stdout\n");
+    return write_raw(proc, raw_out, half_size);
+  }
   printf("Writing TIFF '%s'\n", output.c_str());
-  return write_tiff(proc, attach_profile, output,
-                    // Multi-shot mode always gets the full size.
-                    parser.get<bool>("--quarter_size") && files.size() == 1);
+  return write_tiff(proc, attach_profile, output, half_size);
 }
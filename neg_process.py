@@ -13,559 +13,1085 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+# Developing RAW files of color negatives with the profiles in icc_out.
+#
+# This can be used as a command line tool or imported, e.g. by batch tools, through
+# NegativeProcessor. Importing this module has no side effects and doesn't need
+# matplotlib, the interactive mode lives in neg_interactive.py.
+
 import argparse
+import concurrent.futures
+import contextlib
 import cv2
-import math
+import functools
 import numpy as np
-import colour
 import os
-import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.widgets as widgets
-import matplotlib.patches as patches
-import page_slider
+import neg_film_base
+import neg_metadata
+import neg_profiles
+import neg_render
+import neg_tiff
 from pathlib import Path
 
-parser = argparse.ArgumentParser(
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument(
-    "--emulsion", '-e',
-    choices=[
-        'ektar100',
-        'portra160',
-        'portra400',
-    ],
-    help="Emulsion of the scanned film. Profile will be selected automatically.")
-parser.add_argument(
-    "--profile", '-p',
-    choices=[
-        'ektar100',
-        'ektar100-1',
-        'ektar100-2', # Looks worse than ektar100-1 profile.
-        'ektar100-3', # Poor quality.
-        'ektar100-4', # Poor quality.
-        'ektar100-5', # Poor quality.
-        'ektar100+1',
-        'ektar100+2',
-        'ektar100+3',
-        'portra160',
-        'portra160-1', # Poor quality. Might be better to use portra160 and then brighten image.
-        'portra160+1',
-        'portra160+2',
-        'portra400',
-        'portra400-1', # Poor quality. Might be better to use portra400 and then brighten image.
-        'portra400+1',
-        'portra400+2',
-    ],
-    help="Profile of the scanned film or the name of the generated profile.")
-parser.add_argument(
-    "--profile_type", '-t',
-    choices=['cLUT', 'Matrix'],
-    default='cLUT',
-    help="Profile type used to attach (no -P specified) or to convert (with -P specified).")
-parser.add_argument("--colorspace", '-P', help="Output color profile."
-    " If not spciefied input profile is attached."
-    " If specified then convert using specified profile, default is 'srgb'")
-parser.add_argument(
-    '--raw_file', '-f',
-    help="Name of the input raw file.")
-parser.add_argument(
-    '--film_base_raw_file', '-F',
-    help="Raw file for the capture of the film base."
-    " The channel balance is computed from the film base to compute compensations"
-    " that should be applied to match that of the target. This method is to"
-    " account for variations of the film base density.")
-parser.add_argument(
-    '--film_base_rgb', '-B', nargs=3,
-    help="Uncorrected RGB values of the film base."
-    " The channel balance is computed from the film base to compute compensations"
-    " that should be applied to match that of the target. This method is to"
-    " account for variations of the film base density.")
-# TODO: Fix multi_shot mode for the intermediate runs of neg_process.
-parser.add_argument(
-    '--multi_shot', '-M',
-    action='store_true',
-    help="Sony 4-shots multishot mode. Assume 4 consecutive shots from [raw_file].")
-parser.add_argument(
-    '--no_crop', '-C',
-    action='store_true',
-    default=False,
-    help="No cropping based on aspect ratio from metadata in [raw_file].")
-parser.add_argument(
-    '--interactive_mode', '-i',
-    action='store_true',
-    help="Interactive mode to select profile and parameters.")
-parser.add_argument(
-    '--debug', '-d',
-    action='store_true',
-    help="Debug mode and print neg_process arguments.")
-parser.add_argument(
-    '--measurement', '-m',
-    choices=['', 'R190808'],
-    default='R190808',
-    help="Measurement used.")
-parser.add_argument(
-    '--quality', '-q',
-    default=0,
-    type=int,
-    help="Quality. 0 = linear, 3 = AHD, 11 = DHT, 12 = mod AHD.")
-parser.add_argument(
-    '--color_comp', '-c',
-    help="Multipliers for corrected RGB."
-    " This overrides the --film_base_raw_file option."
-    " The purpose of this flag is to manually adjust channel"
-    " balance before ICC profile is applied.")
-parser.add_argument(
-    '--exposure_comp', '-E',
-    type=float,
-    help="Single multiplier for RGB values.")
-parser.add_argument(
-    '--post_correction_gamma', '-G',
-    type=float,
-    default=1.0,
-    help="Gamma to apply to linear RGB after correction and before ICC is applied."
-    " This is applied to all RGB values and should not affect color balance, the effect is"
-    " to reduce contrast and to recover blown highlight.")
-parser.add_argument(
-    '--half_size', '-H',
-    action='store_true',
-    help="Generate half size image.")
-parser.add_argument(
-    '--quarter_size', '-Q',
-    action='store_true',
-    help="Generate quarter size image.")
-
-parser.add_argument('--target', '-T', action='store_true')
-args = parser.parse_args()
-
-if args.target:
-    subprocess.run([os.path.join(os.path.dirname(__file__), 'bin_out', 'neg_process'),
-                    '--half_size',
-                    '--no_crop',
-                    '-o', Path(args.raw_file).stem + ('.target.tif'),
-                    args.raw_file], check=True)
-    exit(0)
-
-if not args.profile:
-    if not args.emulsion:
-        print('At least --emulsion needs to be specified!')
-        exit(1)
-
-plt.rcParams.update({'font.size': 7})
-plt.rcParams["figure.figsize"] = (15,10)
-plt.rcParams["image.interpolation"] = 'none'
-
-
-def read_profile_info(name):
-    profile_info_txt = '%s/icc_out/Sony A7RM4 %s %s Info.txt' % (os.path.dirname(__file__),
-                                                                 name.capitalize(),
-                                                                 args.measurement)
-    if not os.path.exists(profile_info_txt):
-        return None
-    matrix = []
-    shutter_speed = ''
-    film_base_rgb = []
-    with open(profile_info_txt) as f:
-        for i in range(0, 3):
-            coeffs = f.readline().strip('\r\n').split(' ')[0:3]
-            matrix.append(list(map(float, coeffs)))
-        shutter_speed = f.readline().strip('\r\n').split(' ')[0]
-        film_base_rgb = f.readline().strip('\r\n').split(' ')[0:3]
-        f.readline() # Min
-        f.readline() # Max
-        mean_rgb = f.readline().strip('\r\n').split(' ')[0:3] # Mean
-        mid_grey_rgb = f.readline().strip('\r\n').split(' ')[0:3] # Mid-grey
-    return {
-        'exp': int(name[-2:]) if name[-2] in ['+', '-'] else 0,
-        'emulsion': name[:-2] if name[-2] in ['+', '-'] else name,
-        'name': name,
-        'matrix': matrix,
-        'shutter_speed': float(shutter_speed),
-        'film_base_rgb': list(map(int, film_base_rgb)),
-        'mean_rgb': list(map(float, mean_rgb)),
-        'mid_grey_rgb': list(map(float, mid_grey_rgb)),
-        }
+
+# Header of the raw output of bin_out/neg_process with "-o -", see raw_hdr in neg_process.cc.
+RAW_HEADER = struct.Struct('=4sIII')
+
+# Block size of the binned RAW used to select profiles, about 300 x 200 for a 60MP sensor.
+BIN_SIZE = 32
+
+# Default rows per strip of NegativeProcessor.export_streaming(), about 30MB for a 60MP
+# image in float32.
+STRIP_ROWS = 256
+
+# Output sizes of NegativeProcessor.export_streaming() by the factor the full size is
+# reduced by, 0 for the thumbnail that fits in THUMBNAIL_SIZE.
+OUTPUT_SIZES = {'full': 1, 'half': 2, 'quarter': 4, 'thumbnail': 0}
+THUMBNAIL_SIZE = 800
+
+# Default tolerance of NegativeProcessor.select_profiles() for using the same profile
+# for frames of a roll, in log10 transmittance (about 1/6 stop).
+ROLL_CONSISTENCY = 0.05
+
+
+class NegProcessError(subprocess.CalledProcessError):
+    '''Failure of bin_out/neg_process, the message includes its error output.'''
+
+    def __str__(self):
+        message = super().__str__()
+        if self.stderr:
+            message += '\n' + self.stderr.decode(errors='replace').strip()
+        return message
 
 
 def compute_relative_transmittance(correction_mat, rgb, film_base_rgb):
     return np.matmul(correction_mat, rgb) / np.matmul(correction_mat, film_base_rgb)
 
 
-def get_profile_and_scale_factors(raw_file, film_base_rgb):
-    '''Assuming shutter speed is the only variable between the profile and RAW capture,
-    pick the profile that is most suitable for the RAW capture. Also return the scale
-    factors that should applied to the profiles such that the exposure is uniform.
-    The scale factor dictionary is useful for users to select between profiles with
-    consistent exposure.'''
-    raw_shutter_speed = subprocess.check_output([os.path.join(os.path.dirname(__file__), 'bin_out', 'raw_info'),
-                                                 '-s', raw_file]).decode(sys.stdout.encoding)
-    raw_shutter_speed = float(raw_shutter_speed.split(' ')[0])
-    if args.profile:
-        profile = read_profile_info(args.profile)
-        return profile
-
-    # If profile is not specified use emulsion and shutter speed to select profile automatically.
-    profile = {}
-    profiles = []
-    # Append profiles that are exposed over and under.
-    # Profiles made too under-exposed have poor quality and are excluded.
-    for exp_diff in ['', '-3', '-2', '-1', '+1', '+2', '+3']:
-        exp_diff_profile = read_profile_info(args.emulsion + exp_diff)
-        if exp_diff_profile:
-            exp_diff_profile['exp_diff'] = exp_diff
-            profiles.append(exp_diff_profile)
-
-    # Use the first profile to compute the relative transmittance. Doesn't matter
-    # which profile is choosen because transmittance is relative to the film base
-    # so scaling applied to the corrected RGB values will cancelled out when
-    # divided by the corrected film base RGB values.
-    run_neg_process(args.raw_file, profiles[0], 1, 1, film_base_rgb,
-                    # No ICC profile is applied
-                    None, 4, False, 'temp.tif')
-    neg_img = cv2.imread('temp.tif', cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
-    h, w, _ = neg_img.shape
-    CROP_FACTOR = 7
-    crop_img = cv2.cvtColor(neg_img[int(h/CROP_FACTOR):int(h-h/CROP_FACTOR),
-                                    int(w/CROP_FACTOR):int(w-w/CROP_FACTOR)], cv2.COLOR_BGR2RGB)
-    correction_mat = np.array([profiles[0]['matrix'][0],
-                               profiles[0]['matrix'][1],
-                               profiles[0]['matrix'][2]])
-    corrected_film_base_rgb = np.matmul(correction_mat, film_base_rgb)
-    transmittance_img = crop_img / raw_shutter_speed / corrected_film_base_rgb
-    mean_transmittance = np.mean(transmittance_img, axis = (0,1))
-
-    # mean_rgb in the profile is normalized to 1s so multiply the shutter speed
-    # to get original RGB values.
-    profile_mean_rgb = np.array(profiles[0]['mean_rgb']) * profiles[0]['shutter_speed']
-
-    if args.debug:
-        print("Raw shutter speed: %f" % raw_shutter_speed)
-        print('Mean film RGB: %f %f %f' % tuple(np.mean(crop_img, axis = (0,1))))
-        print('Mean film relative transmittance: %f %f %f' % tuple(mean_transmittance))
-    max_profile_distance = 10000
-    p_to_scale = {}
-    profile_transmittance_vector = []
-    exp_diff_vector = []
-    for p in profiles:
-        correction_mat = np.array([p['matrix'][0], p['matrix'][1], p['matrix'][2]])
-        profile_mid_grey_transmittance = compute_relative_transmittance(
-            correction_mat, p['mid_grey_rgb'], p['film_base_rgb'])
-        profile_mean_transmittance = compute_relative_transmittance(
-            correction_mat, p['mean_rgb'], p['film_base_rgb'])
+class NegativeProcessor:
+    '''Loads profiles, computes the film base, selects profiles and renders RAW files
+    of color negatives.
+
+    One instance can be reused for many frames, the ICC transforms created for
+    rendering are kept. Images passed to render() are the linear RGB returned by
+    decode_linear_image() and the rendered images are uint16 RGB.'''
+
+    def __init__(self, measurement='R190808', profile_type='cLUT', quality=0, multi_shot=False, debug=False,
+                 decode_cache=None, baked_luts=False, camera='Sony A7RM4', strip_rows=0, output_sizes=None,
+                 compression=None, compression_level=None, cache_batch_decodes=False, compression_threads=None):
+        self.measurement = measurement
+        self.camera = camera
+        self.profile_type = profile_type
+        self.quality = quality
+        self.multi_shot = multi_shot
+        self.debug = debug
+        # neg_render.DecodeCache for decode_linear_image(), optional.
+        self.decode_cache = decode_cache
+        # Also store the full decodes of neg_batch.decode_frame() in the decode cache. They
+        # aren't shared with the previews and would push them out of the cache.
+        self.cache_batch_decodes = cache_batch_decodes
+        # Use neg_render.BakedTransform for the ICC transforms in render().
+        self.baked_luts = baked_luts
+        # Rows per strip of export(), 0 to export with bin_out/neg_process.
+        self.strip_rows = strip_rows
+        # Sizes in OUTPUT_SIZES written by export_streaming() from one decode, optional.
+        self.output_sizes = output_sizes
+        # Compression of the TIFF files written by this process, a key of neg_tiff.COMPRESSIONS,
+        # and its level. bin_out/neg_process only writes uncompressed TIFF.
+        self.compression = compression if compression != 'none' else None
+        self.compression_level = compression_level
+        # Threads compressing the TIFF files of a frame, all the cores by default.
+        self.compression_threads = compression_threads
+        # ICC transforms by output colorspace, see renderer().
+        self._transforms = {}
+        # Profiles and their transmittance by emulsion, see profile_table().
+        self._profile_tables = {}
+        # Bytes of the ICC profiles attached to the outputs.
+        self._profile_data = {}
+        # Film base measured on the frames developed so far, see measure_film_base().
+        self.roll_film_base = neg_film_base.RollFilmBase()
+
+    def bin_path(self, name):
+        return os.path.join(os.path.dirname(__file__), 'bin_out', name)
+
+    @property
+    def catalog(self):
+        '''The neg_profiles.ProfileCatalog of icc_out.'''
+        return neg_profiles.catalog()
+
+    def read_profile_info(self, name):
+        '''Returns the info of the profile |name| or None if the profile doesn't exist.
+        A copy is returned so callers can annotate it.'''
+        return self.catalog.get(name, self.measurement, self.camera)
+
+    def profile_icc_path(self, profile):
+        icc_path = profile.get('icc_paths', {}).get(self.profile_type)
+        if icc_path:
+            return icc_path
+        return '%s/icc_out/%s %s %s %s.icc' % (os.path.dirname(__file__),
+                                             self.camera,
+                                             profile['name'].capitalize(),
+                                             self.measurement,
+                                             self.profile_type)
+
+    def output_profile_data(self, profile, colorspace):
+        '''Returns the bytes of the ICC profile attached to an image rendered with |profile|
+        into |colorspace|. Like bin_out/neg_process, the film profile is attached if the
+        image is not converted.'''
+        attach_profile = colorspace or self.profile_icc_path(profile)
+        if attach_profile not in self._profile_data:
+            self._profile_data[attach_profile] = neg_render.read_profile_data(attach_profile)
+        return self._profile_data[attach_profile]
+
+    def raw_metadata(self, raw_files, center_weight=False):
+        '''Returns the metadata of |raw_files| from the metadata store, the files not in the
+        store are read with one bin_out/raw_info invocation. See neg_metadata.py.'''
+        return neg_metadata.raw_metadata(raw_files, self.bin_path('raw_info'), center_weight)
+
+    def raw_shutter_speed(self, raw_file):
+        return self.raw_metadata([raw_file])[0]['shutter_speed']
+
+    def profile_table(self, emulsion):
+        '''Returns the profiles of |emulsion| exposed over and under, and their mid-grey
+        relative transmittance as a profiles x 3 float32 array. This is computed once per
+        emulsion, the profiles returned are copies.'''
+        if emulsion not in self._profile_tables:
+            # The profile without exposure offset first, then the profiles that are
+            # exposed under and over.
+            profiles = sorted(self.catalog.find(emulsion, measurement=self.measurement, camera=self.camera),
+                              key=lambda p: (p['exp'] != 0, p['exp']))
+            if not profiles:
+                raise ValueError('No profiles for emulsion %s' % emulsion)
+            transmittance = []
+            for p in profiles:
+                correction_mat = np.array([p['matrix'][0], p['matrix'][1], p['matrix'][2]])
+                profile_mid_grey_transmittance = compute_relative_transmittance(
+                    correction_mat, p['mid_grey_rgb'], p['film_base_rgb'])
+                transmittance.append(profile_mid_grey_transmittance)
+                if self.debug:
+                    print('[%s] Evaluating profile' % p['name'])
+                    print('  Shutter speed: %f' % p['shutter_speed'])
+                    print('  Mean transmittance: %f %f %f' % tuple(compute_relative_transmittance(
+                        correction_mat, p['mean_rgb'], p['film_base_rgb'])))
+                    print('  Mid-grey transmittance: %f %f %f' % tuple(profile_mid_grey_transmittance))
+            self._profile_tables[emulsion] = (profiles, np.array(transmittance, dtype=np.float32))
+        profiles, transmittance = self._profile_tables[emulsion]
+        return [dict(p) for p in profiles], transmittance
+
+    def select_profile(self, raw_file, film_base_rgb, emulsion=None, profile_name=None):
+        '''Assuming shutter speed is the only variable between the profile and RAW capture,
+        pick the profile that is most suitable for the RAW capture. Also return the scale
+        factors that should applied to the profiles such that the exposure is uniform.
+        The scale factor dictionary is useful for users to select between profiles with
+        consistent exposure.
+
+        Returns the profile, the scale factors by profile name and the map of the best
+        profile exposure for each area of the image (None if |profile_name| is given).'''
+        return self.select_profiles([raw_file], film_base_rgb, emulsion, profile_name)[0]
+
+    def select_profiles(self, raw_files, film_base_rgb, emulsion=None, profile_name=None,
+                        consistency=ROLL_CONSISTENCY):
+        '''Selects the profiles of all |raw_files|, frames of the same roll, in one pass.
+        Returns a list of what select_profile() returns for each frame.
+
+        The RAW files are read in parallel and all frames are scored against all profiles
+        at once. A frame whose distance to the profile chosen for most frames of the roll
+        is within |consistency| (log10 transmittance) of its best profile gets the roll's
+        profile, so similar frames aren't developed at different exposures.'''
+        if not raw_files:
+            return []
+        raw_shutter_speeds = np.array([x['shutter_speed'] for x in self.raw_metadata(raw_files)])
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(len(raw_files), os.cpu_count() or 1))) as executor:
+            if profile_name:
+                profile = self.read_profile_info(profile_name)
+                return [(profile, {profile['name']: profile['shutter_speed'] / x}, None)
+                        for x in raw_shutter_speeds]
+            # The Bayer channels of the RAW are binned instead of debayering, the values are
+            # in the same scale as the decoded image so the correction is the same.
+            linear_imgs = executor.map(self.decode_binned_raw, raw_files)
+
+            # If profile is not specified use emulsion and shutter speed to select profile automatically.
+            profiles, profile_transmittance = self.profile_table(emulsion)
+            # Use the first profile to compute the relative transmittance. Doesn't matter
+            # which profile is choosen because transmittance is relative to the film base
+            # so scaling applied to the corrected RGB values will cancelled out when
+            # divided by the corrected film base RGB values.
+            correction_mat = np.array([profiles[0]['matrix'][0],
+                                       profiles[0]['matrix'][1],
+                                       profiles[0]['matrix'][2]])
+            adjusted_mat = neg_render.adjust_correction_matrix(
+                correction_mat, 1, profiles[0]['film_base_rgb'], film_base_rgb).T.astype(np.float32)
+            corrected_film_base_rgb = np.matmul(correction_mat, film_base_rgb).astype(np.float32)
+            H = 50
+            W = 50
+            mean_transmittance = []
+            transmittance_maps = []
+            for raw_file, raw_shutter_speed, linear_img in zip(raw_files, raw_shutter_speeds, linear_imgs):
+                h, w, _ = linear_img.shape
+                CROP_FACTOR = 7
+                crop_img = linear_img[int(h/CROP_FACTOR):int(h-h/CROP_FACTOR),
+                                      int(w/CROP_FACTOR):int(w-w/CROP_FACTOR)]
+                # Clip the same way as rendering.
+                crop_img = np.clip(np.matmul(crop_img, adjusted_mat), 0, 65535)
+                transmittance_img = crop_img / np.float32(raw_shutter_speed) / corrected_film_base_rgb
+                mean_transmittance.append(np.mean(transmittance_img, axis = (0,1)))
+                transmittance_maps.append(cv2.resize(transmittance_img, (H, W), interpolation = cv2.INTER_AREA))
+                if self.debug:
+                    print('[%s] Raw shutter speed: %f' % (raw_file, raw_shutter_speed))
+                    print('  Mean film RGB: %f %f %f' % tuple(np.mean(crop_img, axis = (0,1))))
+                    print('  Mean film relative transmittance: %f %f %f' % tuple(mean_transmittance[-1]))
+
         # TODO: RGB curves have different gamma values and the log base should be different for channels.
         # A log10 is applied because this is the convention used for density.
-        # Compute th maximum of tranmittance difference among channels and take the profile with the minimum.
-        profile_distance = np.max(np.absolute(np.log10(mean_transmittance) - np.log10(profile_mid_grey_transmittance)))
-        profile_transmittance_vector.append(profile_mid_grey_transmittance)
-        exp_diff_vector.append(int(p['exp_diff'] if p['exp_diff'] else 0))
-        if args.debug:
-            print('[%s] Evaluating profile' % p['name'])
-            print('  Shutter speed: %f' % p['shutter_speed'])
-            print('  Mean transmittance: %f %f %f' % tuple(profile_mean_transmittance))
-            print('  Mid-grey transmittance: %f %f %f' % tuple(profile_mid_grey_transmittance))
-            print("  Mid-grey distance to mean transmittance: %f" % profile_distance)
-        if profile_distance < max_profile_distance and p['exp_diff'] not in ['-2', '-3']:
-            max_profile_distance = profile_distance
-            profile = p
-    H = 50
-    W = 50
-    transmittance_map = cv2.resize(transmittance_img, (H, W), interpolation = cv2.INTER_LINEAR)
-
-    NEW_SHAPE = (H, W, len(profile_transmittance_vector), 3)
-    # TODO: RGB curves have different gamma values and the log base should be different for channels.
-    # Here a log10 is applied because this is the convention used for density.
-    transmittance_diff = np.abs(
-        np.log10(np.reshape(
-            # Repeat by the number of the profiles to compare with.
-            np.repeat(transmittance_map, len(profile_transmittance_vector), axis=1),
-            # Reshape to h * w * profiles * |(r,g,b)|.
-            NEW_SHAPE)) -
-        # Repeat the profile transmittance by number of pixels of the transmittance map.
-        np.log10(np.reshape(profile_transmittance_vector * H * W, NEW_SHAPE)))
-    # For each profile-transmittance-diff within each pixel, take the maximum of diff among r,g,b pixels.
-    # And the compute the minimum among the profiles.
-    exp_map = np.array(exp_diff_vector)[np.argmin(np.max(transmittance_diff, axis=3), axis=2)]
-
-    # Rely on the camera AE to properly expose the captured image. This is not very 
-    # reliable because the shutter speed reported are not very accurate in AE mode.
-    common_scale_factor = np.ones(3) * profile['shutter_speed'] / raw_shutter_speed
-    for p in profiles:
+        log_profile_transmittance = np.log10(profile_transmittance)
+        # Compute the maximum of tranmittance difference among channels, frames x profiles,
+        # and take the profile with the minimum.
+        profile_distance = np.max(np.abs(
+            np.log10(np.array(mean_transmittance))[:, np.newaxis, :] - log_profile_transmittance), axis=2)
+        # Profiles made too under-exposed have poor quality and are excluded.
+        profile_distance[:, [p['exp'] <= -2 for p in profiles]] = np.inf
+        selected = np.argmin(profile_distance, axis=1)
+        if consistency and len(raw_files) > 1:
+            roll_selected = np.argmax(np.bincount(selected, minlength=len(profiles)))
+            close = (profile_distance[:, roll_selected] -
+                     profile_distance[np.arange(len(raw_files)), selected]) <= consistency
+            selected = np.where(close, roll_selected, selected)
+        if self.debug:
+            for raw_file, distance in zip(raw_files, profile_distance):
+                print('[%s] Mid-grey distances to mean transmittance: %s' % (raw_file, ' '.join(
+                    '%s=%f' % (p['name'], d) for p, d in zip(profiles, distance))))
+
+        # The frames x H x W x 1 x 3 maps are broadcast against the profiles x 3 table.
+        # For each profile-transmittance-diff within each pixel, take the maximum of diff among r,g,b pixels.
+        # And the compute the minimum among the profiles.
+        transmittance_diff = np.abs(
+            np.log10(np.array(transmittance_maps))[:, :, :, np.newaxis, :] - log_profile_transmittance)
+        exp_diff_vector = np.array([p['exp'] for p in profiles])
+        exp_maps = exp_diff_vector[np.argmin(np.max(transmittance_diff, axis=4), axis=3)]
+
+        # Rely on the camera AE to properly expose the captured image. This is not very
+        # reliable because the shutter speed reported are not very accurate in AE mode.
+        shutter_speeds = np.array([p['shutter_speed'] for p in profiles])
         # Assume the matrices are scaled by a simple factor between profiles.
         # Ideally the scale factor should be calculated using the matrix for the profile
         # but doing so is costly so assume the scale factor computed from base profile
         # is good enough.
-        p_to_scale[p['name']] = np.mean(common_scale_factor) * (profile['matrix'][0][0] / p['matrix'][0][0])
-        if args.debug:
-            print('[%s] Scaling profile with factor %f' % (p['name'], p_to_scale[p['name']]))
-    return profile, p_to_scale, exp_map
-
-
-def compute_film_base_rgb(film_base_raw_file):
-    '''Returns the film base RGB by computing average from the center of |film_base_raw_file|,
-    multiplied by the 1/shutter_speed.'''
-    raw_info_txt = Path(film_base_raw_file).stem + '.raw_info.txt'
-    if os.path.exists(raw_info_txt):
-        with open(raw_info_txt) as f:
-            output = f.read()
-    else:
-        output = subprocess.check_output([os.path.join(os.path.dirname(__file__), 'bin_out', 'raw_info'),
-                                          '-w', '-s', film_base_raw_file]).decode(sys.stdout.encoding)
-        f = open(raw_info_txt, 'w+')
-        f.write(output)
-        f.close()
-    output = output.split('\n')
-    center_rgb = next((x for x in output if 'average RGB' in x), '1 1 1').split(' ')[0:3]
-    shutter_speed = next((x for x in output if 'Shutter' in x), '1').split(' ')[0]
-    return [int(float(x) / float(shutter_speed)) for x in center_rgb]
-
-
-def run_neg_process(raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, out_file_override=None):
-    neg_process_args = [
-        os.path.join(os.path.dirname(__file__), 'bin_out', 'neg_process'),
-        '--exposure_comp', str(exposure_comp),
-        '-q', str(args.quality)]
-    if profile:
-        neg_process_args += ['-r'] + list(map(str, profile['matrix'][0]))
-        neg_process_args += ['-g'] + list(map(str, profile['matrix'][1]))
-        neg_process_args += ['-b'] + list(map(str, profile['matrix'][2]))
-        neg_process_args += ['--profile_film_base_rgb'] + list(map(str, profile['film_base_rgb']))
-        neg_process_args += ['--film_base_rgb'] + list(map(str, film_base_rgb))
-        neg_process_args += [
-            '-p', '%s/icc_out/Sony A7RM4 %s %s %s.icc' % (os.path.dirname(__file__),
-                                                          profile['name'].capitalize(),
-                                                          args.measurement,
-                                                          args.profile_type)]
-        out_file = Path(raw_file).stem + ('.%s.%s.tif' % (profile['name'], args.profile_type.lower()))
-    if exposure_comp is not None and exposure_comp != 1.0:
-        out_file = Path(raw_file).stem + ('.%s.%s.E=%.2f.tif' % (
-            profile['name'], args.profile_type.lower(), exposure_comp))
-    if post_correction_gamma != 1.0:
-        neg_process_args += ['--post_correction_gamma', str(post_correction_gamma)]
-        out_file = Path(raw_file).stem + ('.%s.%s.E=%.2f.G=%.2f.tif' % (
-            profile['name'], args.profile_type.lower(), exposure_comp, post_correction_gamma))
-    if colorspace:
-        neg_process_args += ['-P', colorspace]
-    if scale_down_factor == 2:
-        neg_process_args.append('--half_size')
-    elif scale_down_factor == 4:
-        neg_process_args.append('--quarter_size')
-    if no_crop:
-        neg_process_args.append('--no_crop')
-    neg_process_args += ['-o', out_file_override or out_file]
-    neg_process_args.append(raw_file)
-    if args.multi_shot:
+        matrix_scales = np.array([p['matrix'][0][0] for p in profiles])
+        scales = ((shutter_speeds[selected] / raw_shutter_speeds * matrix_scales[selected])[:, np.newaxis] /
+                  matrix_scales)
+        results = []
+        for raw_file, i, frame_scales, exp_map in zip(raw_files, selected, scales, exp_maps):
+            p_to_scale = dict(zip([p['name'] for p in profiles], frame_scales))
+            if self.debug:
+                print('[%s] Selected profile %s, scaling profiles with factors %s' % (
+                    raw_file, profiles[i]['name'], ' '.join('%s=%f' % x for x in p_to_scale.items())))
+            results.append((dict(profiles[i]), p_to_scale, exp_map))
+        return results
+
+    def compute_film_base_rgb(self, film_base_raw_file):
+        '''Returns the film base RGB by computing average from the center of |film_base_raw_file|,
+        multiplied by the 1/shutter_speed.'''
+        metadata = self.raw_metadata([film_base_raw_file], center_weight=True)[0]
+        center_rgb = metadata.get('center_rgb', [1, 1, 1])
+        shutter_speed = metadata.get('shutter_speed', 1)
+        return [int(float(x) / float(shutter_speed)) for x in center_rgb]
+
+    def measure_film_base(self, raw_files, emulsion=None, profile_name=None):
+        '''Measures the film base in the rebate of |raw_files| and combines it with the frames
+        measured before by this processor, see neg_film_base.py. The binned RAW used to select
+        profiles is reused. Returns the film base RGB normalized to 1s shutter speed, or None
+        if no frame measured so far has rebate.'''
+        if profile_name:
+            reference_rgb = self.read_profile_info(profile_name)['film_base_rgb']
+        else:
+            reference_rgb = self.profile_table(emulsion)[0][0]['film_base_rgb']
+        shutter_speeds = [x['shutter_speed'] for x in self.raw_metadata(raw_files)]
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(len(raw_files), os.cpu_count() or 1))) as executor:
+            for raw_file, shutter_speed, linear_img in zip(raw_files, shutter_speeds,
+                                                           executor.map(self.decode_binned_raw, raw_files)):
+                measured = neg_film_base.measure_film_base(linear_img, reference_rgb)
+                if measured is None:
+                    if self.debug:
+                        print('[%s] No film base found' % raw_file)
+                    continue
+                rgb, pixels = measured
+                self.roll_film_base.add(rgb / shutter_speed, pixels)
+                if self.debug:
+                    print('[%s] Film base RGB %f %f %f from %d pixels' % ((raw_file,) + tuple(rgb) + (pixels,)))
+        return self.roll_film_base.film_base_rgb()
+
+    def decode_linear_image(self, raw_file, scale_down_factor, no_crop, region=None, cache=True):
+        '''Returns the linear (uncorrected) RGB image from |raw_file| as a float32 array.
+        This is the output of bin_out/neg_process with the identity matrix and no ICC profile.
+        If |region| is specified only that (left, top, width, height) of the full size image is decoded.
+        With the decode cache the image is a read-only memory-mapped array. If |cache| is False
+        a cached decode is used but a new decode isn't stored.'''
+        if self.decode_cache:
+            key = self._decode_cache_key(raw_file, scale_down_factor, no_crop, region)
+            linear_img = self.decode_cache.get(key)
+            if linear_img is not None:
+                return linear_img
+        linear_img = self.read_neg_process(raw_file, None, 1.0, 1.0, None, None, scale_down_factor, no_crop,
+                                           region).astype(np.float32)
+        if self.decode_cache and cache:
+            linear_img = self.decode_cache.put(key, linear_img)
+        return linear_img
+
+    def _decode_cache_key(self, raw_file, scale_down_factor, no_crop, region=None):
+        # The other captures of a pixel shift capture are merged into the decode too.
+        shots = []
+        for shot in self.multi_shot_files(raw_file):
+            try:
+                st = os.stat(shot)
+                shots.append((os.path.realpath(shot), st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                shots.append((os.path.realpath(shot), None, None))
+        return self.decode_cache.key(raw_file, quality=self.quality, multi_shot=self.multi_shot,
+                                     scale_down_factor=scale_down_factor, no_crop=no_crop,
+                                     region=region and tuple(region), shots=tuple(shots))
+
+    def renderer(self, linear_img, colorspace='srgb', baked=None):
+        '''Returns a neg_render.PreviewRenderer for |linear_img| that shares the ICC
+        transforms of this processor. |baked| overrides baked_luts.'''
+        return neg_render.PreviewRenderer(linear_img, colorspace,
+                                          transforms=self._transforms.setdefault(colorspace, {}),
+                                          baked=self.baked_luts if baked is None else baked)
+
+    def render(self, linear_img, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace='srgb'):
+        '''Renders |linear_img| with |profile| the same way bin_out/neg_process does.
+        Returns a uint16 RGB image in |colorspace|.'''
+        return self.renderer(linear_img, colorspace).render(
+            profile['matrix'], self.profile_icc_path(profile), exposure_comp, post_correction_gamma,
+            profile['film_base_rgb'], film_base_rgb)
+
+    def neg_process_command(self, raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, out_file_override=None, region=None):
+        '''Returns the bin_out/neg_process arguments and the output file. See run_neg_process().'''
+        neg_process_args = [
+            self.bin_path('neg_process'),
+            '--exposure_comp', str(exposure_comp),
+            '-q', str(self.quality)]
+        if profile:
+            neg_process_args += ['-r'] + list(map(str, profile['matrix'][0]))
+            neg_process_args += ['-g'] + list(map(str, profile['matrix'][1]))
+            neg_process_args += ['-b'] + list(map(str, profile['matrix'][2]))
+            neg_process_args += ['--profile_film_base_rgb'] + list(map(str, profile['film_base_rgb']))
+            neg_process_args += ['--film_base_rgb'] + list(map(str, film_base_rgb))
+            neg_process_args += ['-p', self.profile_icc_path(profile)]
+            out_file = Path(raw_file).stem + ('.%s.%s.tif' % (profile['name'], self.profile_type.lower()))
+        if exposure_comp is not None and exposure_comp != 1.0:
+            out_file = Path(raw_file).stem + ('.%s.%s.E=%.2f.tif' % (
+                profile['name'], self.profile_type.lower(), exposure_comp))
+        if post_correction_gamma != 1.0:
+            neg_process_args += ['--post_correction_gamma', str(post_correction_gamma)]
+            out_file = Path(raw_file).stem + ('.%s.%s.E=%.2f.G=%.2f.tif' % (
+                profile['name'], self.profile_type.lower(), exposure_comp, post_correction_gamma))
+        if colorspace:
+            neg_process_args += ['-P', colorspace]
+        if scale_down_factor == 2:
+            neg_process_args.append('--half_size')
+        elif scale_down_factor == 4:
+            neg_process_args.append('--quarter_size')
+        if no_crop:
+            neg_process_args.append('--no_crop')
+        if region:
+            neg_process_args += ['--region'] + list(map(str, region))
+        neg_process_args += ['-o', out_file_override or out_file]
+        neg_process_args.append(raw_file)
+        neg_process_args += self.multi_shot_files(raw_file)
+        return neg_process_args, out_file_override or out_file
+
+    def multi_shot_files(self, raw_file):
+        '''Returns the other 3 captures of the pixel shift capture starting with |raw_file|,
+        none if not in multi-shot mode.'''
+        if not self.multi_shot:
+            return []
         file_num = int(Path(raw_file).stem[-4:])
-        for i in range(1,4):
-            neg_process_args.append(Path(raw_file).stem[0:-4] + str(file_num + i) + Path(raw_file).suffix)
-    if args.debug:
-        print(' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
-        subprocess.run(neg_process_args, check=True)
-    else:
-        subprocess.check_output(neg_process_args)
-    return out_file_override or out_file
-
-
-class FilmBaseSelector:
-    def _line_select_callback(self, eclick, erelease):
-        x1, y1 = eclick.xdata, eclick.ydata
-        x2, y2 = erelease.xdata, erelease.ydata
-
-    def show_selector(self, path):
-        film_base_img = cv2.imread(path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
-        film_base_img = cv2.cvtColor(film_base_img, cv2.COLOR_BGR2RGB)
-        thumb_img = cv2.normalize(film_base_img, None, 0, 255, norm_type=cv2.NORM_MINMAX)
-        
-        fig, ax = plt.subplots(1)
-        plot = ax.imshow(thumb_img)
-        fig.tight_layout()
-        selector = widgets.RectangleSelector(ax, self._line_select_callback,
-                                             useblit=True,
-                                             button=[1, 3],  # don't use middle button
-                                             minspanx=5, minspany=5,
-                                             spancoords='pixels',
-                                             interactive=True)
-        img_h, img_w, _ = thumb_img.shape
-        patch_w = min(img_h, img_w) / 4
-        ax.add_patch(patches.Rectangle(
-                ((img_w - patch_w) / 2, (img_h - patch_w) / 2),
-                patch_w, patch_w, linewidth=1, edgecolor='r', facecolor='none'))
-        plt.show()
-        xmin, xmax, ymin, ymax = selector.extents
-        if xmax > xmin and ymax > ymin + 1:
-            selected_img = film_base_img[int(ymin):int(ymax), int(xmin):int(xmax)]
-            return [int(x) for x in np.mean([selected_img], axis=(0, 1, 2))]
-        return None
-
-
-selected_film_base_rgb = None
-if args.film_base_raw_file and args.interactive_mode:
-    film_base_tif = run_neg_process(args.film_base_raw_file, None, 1.0, 1.0, None, None, 4, True, 'film_base.tif')
-    selected_film_base_rgb = FilmBaseSelector().show_selector(film_base_tif)
-    if selected_film_base_rgb:
-        raw_shutter_speed = subprocess.check_output([os.path.join(os.path.dirname(__file__), 'bin_out', 'raw_info'),
-                                                     '-s', args.film_base_raw_file]).decode(sys.stdout.encoding)
-        # TODO: Optimize this read from .raw_info.txt file.
-        raw_shutter_speed = float(raw_shutter_speed.split(' ')[0])
-        if args.debug:
-            print('Selected film base shutter speed: %f' % raw_shutter_speed)
-        selected_film_base_rgb = [int(x / raw_shutter_speed) for x in selected_film_base_rgb]
-        print("Selected Film Base RGB: %d %d %d (normalized to 1s shutter speed)" % tuple(selected_film_base_rgb))
-
-if selected_film_base_rgb is None:
-    if args.film_base_raw_file:
-        selected_film_base_rgb = compute_film_base_rgb(args.film_base_raw_file)
-        print('Computed film base RGB %d %d %d (normalized to 1s shutter speed)' % tuple(selected_film_base_rgb))
-    else:
-        selected_film_base_rgb = list(map(int, args.film_base_rgb))
-        print('Entered film base RGB %d %d %d (normalized to 1s shutter speed)' % tuple(selected_film_base_rgb))
-
-start = time.time()
-profile, p_to_scale, exp_map = get_profile_and_scale_factors(args.raw_file, selected_film_base_rgb)
-print("Chosen profile %s in %f seconds with shutter speed %f." % (profile['name'], time.time() - start, profile['shutter_speed']))
-
-# Current params.
-exp_comp = args.exposure_comp if args.exposure_comp else p_to_scale[profile['name']]
-gamma = 1
-profile_exp = profile['exp']
-last_out_path = None
-
-if not args.interactive_mode:
-    out_file = run_neg_process(args.raw_file, profile, exp_comp, args.post_correction_gamma, selected_film_base_rgb, args.colorspace, 2 if args.half_size else (4 if args.quarter_size else 1), args.no_crop)
-    print('Done %s' % out_file)
-    exit(0)
-
-fig, ax_img = plt.subplots()
-fig.tight_layout()
-
-ax_gamma = fig.add_axes([0.825, 0.30, 0.15, 0.018])
-ax_exp_comp = fig.add_axes([0.825, 0.35, 0.15, 0.018])
-ax_profile = fig.add_axes([0.825, 0.40, 0.15, 0.018])
-ax_density_map = fig.add_axes([0.82, 0.439, 0.15, 0.20])
-ax_color_bar = fig.add_axes([0.965, 0.439, 0.01, 0.20])
-ax_lab_hist = fig.add_axes([0.825, 0.68, 0.15, 0.10])
-ax_l_hist = fig.add_axes([0.825, 0.82, 0.15, 0.10])
-
-norm = matplotlib.colors.BoundaryNorm(np.linspace(-3, 4, 8), plt.cm.bone.N)
-ax_density_map.set_title('Density Map')
-im_density_map = ax_density_map.imshow(exp_map, cmap='bone', norm=norm)
-fig.colorbar(im_density_map, cax=ax_color_bar, orientation='vertical', cmap='bone', norm=norm, ticks=np.arange(-3, 4))
-def im_density_map_onclick(event):
-    if event.xdata != None and event.ydata != None and event.inaxes == ax_density_map:
-        val = event.inaxes.get_images()[0].get_cursor_data(event)
-        slider_profile.set_val(val)
-im_density_map.figure.canvas.mpl_connect('button_press_event', im_density_map_onclick)
-
-slider_exp_comp = widgets.Slider(ax_exp_comp, 'Exp. Comp.', 0, 3, valinit=exp_comp)
-slider_gamma = widgets.Slider(ax_gamma, 'Gamma', 0, 3, valinit=gamma)
-
-slider_profile = page_slider.PageSlider(ax_profile, 'Profile Exp', min_page=-3, max_page=3, activecolor="orange", valinit=profile_exp)
-
-fig.subplots_adjust(right=0.80)
-
-def reprocess_and_show_image():
-    global profile
-    global last_out_path
-    global exp_comp
+        return [Path(raw_file).stem[0:-4] + str(file_num + i) + Path(raw_file).suffix for i in range(1, 4)]
+
+    def run_neg_process(self, raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, out_file_override=None, region=None):
+        neg_process_args, out_file = self.neg_process_command(
+            raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace,
+            scale_down_factor, no_crop, out_file_override, region)
+        if self.debug:
+            print(' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
+            subprocess.run(neg_process_args, check=True)
+        else:
+            result = subprocess.run(neg_process_args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode:
+                raise NegProcessError(result.returncode, neg_process_args, stderr=result.stderr)
+        return out_file
+
+    @property
+    def streaming(self):
+        '''Whether export() uses export_streaming().'''
+        return bool(self.strip_rows or self.output_sizes or self.compression)
+
+    def export(self, raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, out_file_override=None):
+        '''Develops |raw_file| into a TIFF with export_streaming() if strip_rows, output_sizes
+        or compression is set, or with run_neg_process(). Returns the output file, the largest
+        one if there are several sizes.'''
+        export = self.export_streaming if self.streaming else self.run_neg_process
+        return export(raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace,
+                      scale_down_factor, no_crop, out_file_override)
+
+    def export_streaming(self, raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, out_file_override=None):
+        '''Develops |raw_file| like run_neg_process() but the linear image is read from
+        bin_out/neg_process, or the decode cache, and goes through the correction matrix,
+        gamma, ICC transform and into the TIFF in strips of strip_rows rows. The memory used
+        by this process depends on the strip size, not on the image size.
+
+        If output_sizes is set, a TIFF is written for each of the sizes from the one decode
+        and render, |scale_down_factor| is not used. The smaller sizes are reduced from the
+        rendered strips with a box filter. Returns the largest output file.'''
+        size_factors = self._size_factors(scale_down_factor)
+        scale_down_factor = self.decode_scale_down_factor(scale_down_factor)
+        out_file = out_file_override or self.neg_process_command(
+            raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace,
+            scale_down_factor, no_crop)[1]
+        linear_img = None
+        if self.decode_cache:
+            linear_img = self.decode_cache.get(self._decode_cache_key(raw_file, scale_down_factor, no_crop))
+        raw_strips = None
+        if linear_img is not None:
+            height, width, _ = linear_img.shape
+        else:
+            height, width, raw_strips = self._read_raw_output_strips(self.neg_process_command(
+                raw_file, None, 1.0, 1.0, None, None, scale_down_factor, no_crop, '-')[0])
+
+        try:
+            factors = self._box_factors(size_factors, scale_down_factor, width, height)
+            # Strips are whole blocks of all the box filters.
+            strip_rows = self.strip_rows or STRIP_ROWS
+            strip_rows = -(-strip_rows // np.lcm.reduce(list(factors.values()))) * np.lcm.reduce(list(factors.values()))
+            if linear_img is not None:
+                # Memory-mapped, only the pages of the current strip are read.
+                strips = (linear_img[y:y + strip_rows] for y in range(0, height, strip_rows))
+            else:
+                strips = self._rechunk(raw_strips, strip_rows)
+
+            renderer = self.renderer(None, colorspace)
+            icc_profile = self.output_profile_data(profile, colorspace)
+            with self._output_writers(out_file, factors, icc_profile) as writers:
+                for strip in renderer.render_strips(strips, profile['matrix'], self.profile_icc_path(profile),
+                                                    exposure_comp, post_correction_gamma, profile['film_base_rgb'],
+                                                    film_base_rgb):
+                    for size, writer in writers.items():
+                        writer.write(neg_render.box_reduce(strip, factors[size]))
+        finally:
+            # Stops bin_out/neg_process if the strips weren't all read.
+            if raw_strips:
+                raw_strips.close()
+        return out_file
+
+    def write_outputs(self, out_file, img, icc_profile, scale_down_factor):
+        '''Writes |img|, rendered from a decode at decode_scale_down_factor(|scale_down_factor|),
+        to |out_file| and the other output_sizes the same as export_streaming(). Returns the
+        largest output file.'''
+        height, width, _ = img.shape
+        factors = self._box_factors(self._size_factors(scale_down_factor),
+                                    self.decode_scale_down_factor(scale_down_factor), width, height)
+        with self._output_writers(out_file, factors, icc_profile) as writers:
+            for size, writer in writers.items():
+                writer.write(neg_render.box_reduce(img, factors[size]))
+        return out_file
+
+    def decode_scale_down_factor(self, scale_down_factor):
+        '''Returns the scale down factor of the decode for the outputs, |scale_down_factor|
+        unless output_sizes is set.'''
+        if not self.output_sizes:
+            return scale_down_factor
+        # Decode at the largest size needed, quarter size is enough for a thumbnail.
+        return min([x for x in self._size_factors(scale_down_factor).values() if x] or [4])
+
+    def _size_factors(self, scale_down_factor):
+        '''Returns the scale down factor of each output by size name.'''
+        if self.output_sizes:
+            return {size: OUTPUT_SIZES[size] for size in self.output_sizes}
+        return {'full': scale_down_factor}
+
+    @staticmethod
+    def _box_factors(size_factors, scale_down_factor, width, height):
+        '''Returns the box filter factor of each output relative to the |width| x |height|
+        image decoded at |scale_down_factor|.'''
+        factors = {}
+        for size, size_factor in size_factors.items():
+            if size_factor:
+                factors[size] = size_factor // scale_down_factor
+            else:
+                factors[size] = max(1, -(-max(width, height) // THUMBNAIL_SIZE))
+        return factors
+
+    @contextlib.contextmanager
+    def _output_writers(self, out_file, factors, icc_profile):
+        '''Returns a context manager of the neg_tiff.TiffWriter by size, closed on exit. The
+        largest size is written to |out_file|, the others get the size added to the name.
+        The writers share one pool of compression_threads threads.'''
+        out_files = {size: out_file if i == 0 else '%s.%s.tif' % (os.path.splitext(out_file)[0], size)
+                     for i, size in enumerate(sorted(factors, key=factors.get))}
+        threads = self.compression_threads or os.cpu_count() or 1
+        executor = concurrent.futures.ThreadPoolExecutor(threads) if self.compression else None
+        writers = {}
+        try:
+            for size in factors:
+                if self.debug:
+                    print('Writing %s size %s' % (size, out_files[size]))
+                writers[size] = neg_tiff.TiffWriter(out_files[size], icc_profile, compression=self.compression,
+                                                    level=self.compression_level, threads=threads,
+                                                    executor=executor)
+            yield writers
+        finally:
+            for writer in writers.values():
+                writer.close()
+            if executor:
+                executor.shutdown()
+
+    @staticmethod
+    def _rechunk(strips, strip_rows):
+        '''Yields the rows of |strips| in strips of |strip_rows| rows, the last one can be smaller.'''
+        pending = []
+        pending_rows = 0
+        for strip in strips:
+            pending.append(strip)
+            pending_rows += len(strip)
+            while pending_rows >= strip_rows:
+                rows = np.concatenate(pending) if len(pending) > 1 else pending[0]
+                yield rows[:strip_rows]
+                pending = [rows[strip_rows:]]
+                pending_rows -= strip_rows
+        if pending_rows:
+            yield np.concatenate(pending)
+
+    def read_neg_process(self, raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace, scale_down_factor, no_crop, region=None):
+        '''Runs bin_out/neg_process like run_neg_process() but the image is read from its
+        stdout instead of a file. Returns a H x W x 3 uint16 RGB array wrapping the buffer
+        the pixels were read into.'''
+        neg_process_args, _ = self.neg_process_command(
+            raw_file, profile, exposure_comp, post_correction_gamma, film_base_rgb, colorspace,
+            scale_down_factor, no_crop, '-', region)
+        if self.debug:
+            print(' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
+        return self._read_raw_output(neg_process_args)
+
+    def decode_binned_raw(self, raw_file, bin_size=None):
+        '''Returns the Bayer channels of |raw_file| averaged in blocks of |bin_size| x |bin_size|
+        pixels as a float32 RGB array, in the same scale as decode_linear_image(). The RAW
+        file is not debayered nor cropped and only the first capture is read in multi-shot
+        mode, so this is a small fraction of the time and memory of a decode.'''
+        bin_size = bin_size or BIN_SIZE
+        if self.decode_cache:
+            key = self.decode_cache.key(raw_file, bin_size=bin_size)
+            linear_img = self.decode_cache.get(key)
+            if linear_img is not None:
+                return linear_img
+        neg_process_args = [self.bin_path('neg_process'), '--bin', str(bin_size), '-o', '-', raw_file]
+        if self.debug:
+            print(' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
+        linear_img = self._read_raw_output(neg_process_args).astype(np.float32)
+        if self.decode_cache:
+            linear_img = self.decode_cache.put(key, linear_img)
+        return linear_img
+
+    def _read_raw_output_strips(self, neg_process_args, strip_rows=STRIP_ROWS):
+        '''Runs |neg_process_args| that write to stdout. Returns the height and width of the
+        image and a generator of strips of |strip_rows| rows, uint16 arrays each read into
+        its own buffer. Closing the generator stops the process, even if no strip was read.'''
+        if self.debug:
+            print(' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
+        stderr_file = self._stderr_file()
+        proc = subprocess.Popen(neg_process_args, stdout=subprocess.PIPE, stderr=stderr_file)
+        header = proc.stdout.read(RAW_HEADER.size)
+        if len(header) != RAW_HEADER.size or RAW_HEADER.unpack(header)[0] != b'NRGB':
+            with proc:
+                pass
+            raise self._neg_process_error(proc, neg_process_args, stderr_file)
+        _, width, height, channels = RAW_HEADER.unpack(header)
+
+        def strips():
+            read_rows = 0
+            try:
+                with proc:
+                    # Started below so that close() runs the cleanup before the first strip.
+                    yield None
+                    while read_rows < height:
+                        rows = min(strip_rows, height - read_rows)
+                        buf = bytearray(rows * width * channels * 2)
+                        if proc.stdout.readinto(buf) != len(buf):
+                            break
+                        read_rows += rows
+                        yield np.frombuffer(buf, dtype=np.uint16).reshape(rows, width, channels)
+                if proc.returncode or read_rows != height:
+                    raise self._neg_process_error(proc, neg_process_args, stderr_file)
+            finally:
+                if stderr_file:
+                    stderr_file.close()
+        generator = strips()
+        next(generator)
+        return height, width, generator
+
+    def _stderr_file(self):
+        '''Returns the file to capture the error output of bin_out/neg_process in, None to
+        show it in debug mode. A file instead of a pipe can't block the process when stdout
+        is read.'''
+        return None if self.debug else tempfile.TemporaryFile()
+
+    @staticmethod
+    def _neg_process_error(proc, neg_process_args, stderr_file):
+        stderr = None
+        if stderr_file:
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            stderr_file.close()
+        return NegProcessError(proc.returncode, neg_process_args, stderr=stderr)
+
+    def _read_raw_output(self, neg_process_args):
+        stderr_file = self._stderr_file()
+        with subprocess.Popen(neg_process_args, stdout=subprocess.PIPE, stderr=stderr_file) as proc:
+            header = proc.stdout.read(RAW_HEADER.size)
+            if len(header) == RAW_HEADER.size:
+                magic, width, height, channels = RAW_HEADER.unpack(header)
+                buf = bytearray(width * height * channels * 2)
+                view = memoryview(buf)
+                pos = 0
+                while pos < len(buf):
+                    n = proc.stdout.readinto(view[pos:])
+                    if not n:
+                        break
+                    pos += n
+        if proc.returncode or len(header) != RAW_HEADER.size or magic != b'NRGB' or pos != len(buf):
+            raise self._neg_process_error(proc, neg_process_args, stderr_file)
+        if stderr_file:
+            stderr_file.close()
+        return np.frombuffer(buf, dtype=np.uint16).reshape(height, width, channels)
+
+
+class SpeculativeExport:
+    '''Runs the final export in the background once parameters have not changed for
+    |idle_delay| seconds, so that the output is likely ready when the user is done.
+
+    |command| is called as command(params) and returns the bin_out/neg_process arguments
+    that write to |out_file|. Any change of parameters kills the export in progress,
+    parameters are compared by value.'''
+
+    def __init__(self, command, out_file, idle_delay=1.5, debug=False):
+        self._command = command
+        self._debug = debug
+        self._out_file = out_file
+        self._idle_delay = idle_delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self._proc = None
+        self._proc_params = None
+
+    def update(self, params):
+        with self._lock:
+            # The export of |params| is pending, running or done.
+            if params == self._proc_params or (self._timer and self._timer.args[0] == params):
+                return
+            self._cancel_locked()
+            self._timer = threading.Timer(self._idle_delay, self._start, [params])
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _start(self, params):
+        with self._lock:
+            if self._timer is None or self._timer.args[0] != params:
+                return
+            neg_process_args = self._command(params)
+            if self._debug:
+                print('Speculative export: ' + ' '.join([("'" + x + "'" if ' ' in x else x) for x in neg_process_args]))
+            self._proc = subprocess.Popen(neg_process_args, stdout=subprocess.DEVNULL)
+            self._proc_params = params
+
+    def _cancel_locked(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._proc:
+            if self._proc.poll() is None:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+            self._proc_params = None
+            if os.path.exists(self._out_file):
+                os.remove(self._out_file)
+
+    def finish(self, params):
+        '''Returns the output file if an export with |params| has completed, waiting if it
+        is still running. Otherwise cancels any export and returns None.'''
+        with self._lock:
+            proc = self._proc
+            if proc is None or self._proc_params != params:
+                self._cancel_locked()
+                return None
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        if proc.wait() != 0:
+            if os.path.exists(self._out_file):
+                os.remove(self._out_file)
+            return None
+        return self._out_file
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--emulsion", '-e',
+        help="Emulsion of the scanned film, one of those in icc_out, e.g. ektar100, portra160 or portra400."
+        " Profile will be selected automatically.")
+    parser.add_argument(
+        "--profile", '-p',
+        help="Profile of the scanned film or the name of the generated profile, one of those in"
+        " icc_out, e.g. portra400 or ektar100+1.")
+    parser.add_argument(
+        "--profile_type", '-t',
+        choices=['cLUT', 'Matrix'],
+        default='cLUT',
+        help="Profile type used to attach (no -P specified) or to convert (with -P specified).")
+    parser.add_argument("--colorspace", '-P', help="Output color profile."
+        " If not spciefied input profile is attached."
+        " If specified then convert using specified profile, default is 'srgb'")
+    parser.add_argument(
+        '--raw_file', '-f',
+        help="Name of the input raw file.")
+    parser.add_argument(
+        '--film_base_raw_file', '-F',
+        help="Raw file for the capture of the film base."
+        " The channel balance is computed from the film base to compute compensations"
+        " that should be applied to match that of the target. This method is to"
+        " account for variations of the film base density.")
+    parser.add_argument(
+        '--film_base_rgb', '-B', nargs=3,
+        help="Uncorrected RGB values of the film base."
+        " The channel balance is computed from the film base to compute compensations"
+        " that should be applied to match that of the target. This method is to"
+        " account for variations of the film base density. If neither this nor"
+        " --film_base_raw_file is given the film base is measured from the rebate of the frames.")
+    # TODO: Fix multi_shot mode for the intermediate runs of neg_process.
+    parser.add_argument(
+        '--multi_shot', '-M',
+        action='store_true',
+        help="Sony 4-shots multishot mode. Assume 4 consecutive shots from [raw_file].")
+    parser.add_argument(
+        '--no_crop', '-C',
+        action='store_true',
+        default=False,
+        help="No cropping based on aspect ratio from metadata in [raw_file].")
+    parser.add_argument(
+        '--interactive_mode', '-i',
+        action='store_true',
+        help="Interactive mode to select profile and parameters.")
+    parser.add_argument(
+        '--no_progressive_preview',
+        action='store_true',
+        help="In interactive mode always render the preview at quarter size."
+        " By default a 1/8 size draft is shown first and refined when parameters stop changing.")
+    parser.add_argument(
+        '--preview_cache_mb',
+        type=int,
+        default=512,
+        help="Memory used to keep rendered previews in interactive mode, so that going back to"
+        " previously seen parameters doesn't render again.")
+    parser.add_argument(
+        '--lab_stats_stride',
+        type=int,
+        default=4,
+        help="Compute the Lab histograms in interactive mode from every n-th row and column of the preview.")
+    parser.add_argument(
+        '--debug', '-d',
+        action='store_true',
+        help="Debug mode and print neg_process arguments.")
+    parser.add_argument(
+        '--camera',
+        default='Sony A7RM4',
+        help="Camera the profiles are made for, as in the names of the profiles in icc_out.")
+    parser.add_argument(
+        '--measurement', '-m',
+        choices=['', 'R190808'],
+        default='R190808',
+        help="Measurement used.")
+    parser.add_argument(
+        '--quality', '-q',
+        default=0,
+        type=int,
+        help="Quality. 0 = linear, 3 = AHD, 11 = DHT, 12 = mod AHD.")
+    parser.add_argument(
+        '--color_comp', '-c',
+        help="Multipliers for corrected RGB."
+        " This overrides the --film_base_raw_file option."
+        " The purpose of this flag is to manually adjust channel"
+        " balance before ICC profile is applied.")
+    parser.add_argument(
+        '--exposure_comp', '-E',
+        type=float,
+        help="Single multiplier for RGB values.")
+    parser.add_argument(
+        '--post_correction_gamma', '-G',
+        type=float,
+        default=1.0,
+        help="Gamma to apply to linear RGB after correction and before ICC is applied."
+        " This is applied to all RGB values and should not affect color balance, the effect is"
+        " to reduce contrast and to recover blown highlight.")
+    parser.add_argument(
+        '--half_size', '-H',
+        action='store_true',
+        help="Generate half size image.")
+    parser.add_argument(
+        '--quarter_size', '-Q',
+        action='store_true',
+        help="Generate quarter size image.")
+
+    parser.add_argument('--target', '-T', action='store_true')
+    parser.add_argument(
+        '--roll', '-R',
+        help="Directory or glob of the raw files of a roll to process in batch."
+        " The film base is computed once and each frame gets its own profile.")
+    parser.add_argument(
+        '--jobs', '-j', type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes for --roll.")
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help="Process --roll in one process that decodes the next frame, renders the current"
+        " frame and writes the previous frame at the same time, instead of a pool of workers.")
+    parser.add_argument(
+        '--queue_size', type=int,
+        default=2,
+        help="Maximum number of frames waiting between two stages of --pipeline and --watch.")
+    parser.add_argument(
+        '--watch', '-W',
+        help="Directory to watch during a scanning session. New raw files are developed"
+        " with the same emulsion and film base as soon as they are completely written.")
+    parser.add_argument(
+        '--settle_time', type=float,
+        default=2.0,
+        help="Seconds a raw file in --watch has to stay unchanged before it's developed.")
+    parser.add_argument(
+        '--decode_cache_gb', type=float,
+        default=8,
+        help="Size of the cache of decoded raw files shared by all runs, 0 to disable."
+        " The cache is in %s." % os.path.join(neg_render.CACHE_DIR, 'decoded'))
+    parser.add_argument(
+        '--cache_batch_decodes',
+        action='store_true',
+        help="Also store the full decodes of --pipeline, --watch and --serve in the decode cache."
+        " By default they are not stored, they are large and would evict the previews.")
+    parser.add_argument(
+        '--baked_lut',
+        action='store_true',
+        help="Apply the ICC profile with a 3D LUT baked for each profile and colorspace in"
+        " --pipeline, --watch and --serve. Previews always use it. Colors are within one 8-bit"
+        " level of LittleCMS except near clipped colors, see BakedTransform in neg_render.py.")
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help="Run a server for conversion jobs that keeps the profiles and ICC transforms"
+        " in memory, see neg_server.py for the protocol.")
+    parser.add_argument(
+        '--port', type=int,
+        default=8765,
+        help="Localhost port of --serve.")
+    parser.add_argument(
+        '--socket',
+        help="Unix socket of --serve, used instead of --port.")
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help="Export in strips through the correction, gamma and ICC transform so the memory used"
+        " doesn't depend on the image size. Used for single frames, --interactive_mode and --roll without --pipeline."
+        " Large files are written as BigTIFF.")
+    parser.add_argument(
+        '--strip_rows', type=int,
+        default=STRIP_ROWS,
+        help="Rows per strip of --stream.")
+    parser.add_argument(
+        '--sizes',
+        help="Comma separated output sizes written from one decode, any of %s, e.g. 'full,half,thumbnail'."
+        " The largest is named as usual and the others get the size added to the name. The smaller"
+        " sizes are box filtered from the rendered image, the thumbnail fits in %dx%d. Implies --stream"
+        " except in --pipeline, --watch and --serve, and overrides --half_size and --quarter_size and the"
+        " size of --serve jobs." % (', '.join(OUTPUT_SIZES), THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    parser.add_argument(
+        '--compression',
+        choices=list(neg_tiff.COMPRESSIONS), default='none',
+        help="Compression of the output TIFF, with the horizontal predictor. Strips are compressed"
+        " on all the cores. ZSTD needs the zstandard or imagecodecs module and LZW needs imagecodecs."
+        " Implies --stream. Run neg_tiff.py to compare the levels.")
+    parser.add_argument(
+        '--compression_level', type=int,
+        help="Level of %s compression, default %s." % (
+            ' or '.join('%s (%d-%d)' % (name, levels[0], levels[-1]) for name, levels in neg_tiff.LEVELS.items()),
+            ', '.join('%d for %s' % (level, name) for name, level in neg_tiff.DEFAULT_LEVELS.items())))
+    parser.add_argument(
+        '--raw_info',
+        help="Read the metadata of the raw files in this directory, or matching this glob, into the"
+        " metadata store with one bin_out/raw_info run and print it. The center-weight averages are"
+        " included, see neg_metadata.py.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.sizes and not set(args.sizes.split(',')) <= set(OUTPUT_SIZES):
+        print('--sizes must be a list of %s' % ', '.join(OUTPUT_SIZES))
+        return 1
+    if args.compression_level is not None and args.compression == 'none':
+        print('--compression_level needs --compression')
+        return 1
+    if args.compression != 'none':
+        try:
+            neg_tiff.compressor(args.compression, args.compression_level)
+        except ValueError as e:
+            print(e)
+            return 1
+    decode_cache = None
+    if args.decode_cache_gb > 0:
+        decode_cache = neg_render.DecodeCache(int(args.decode_cache_gb * 1024 ** 3))
+    processor = NegativeProcessor(measurement=args.measurement,
+                                  profile_type=args.profile_type,
+                                  quality=args.quality,
+                                  multi_shot=args.multi_shot,
+                                  debug=args.debug,
+                                  decode_cache=decode_cache,
+                                  baked_luts=args.baked_lut,
+                                  camera=args.camera,
+                                  strip_rows=args.strip_rows if args.stream else 0,
+                                  output_sizes=args.sizes and args.sizes.split(','),
+                                  compression=args.compression,
+                                  compression_level=args.compression_level,
+                                  cache_batch_decodes=args.cache_batch_decodes)
+
+    if args.target:
+        subprocess.run([processor.bin_path('neg_process'),
+                        '--half_size',
+                        '--no_crop',
+                        '-o', Path(args.raw_file).stem + ('.target.tif'),
+                        args.raw_file], check=True)
+        return 0
+
+    if args.raw_info:
+        import neg_batch
+        raw_files = neg_batch.list_raw_files(args.raw_info)
+        start = time.time()
+        for raw_file, metadata in zip(raw_files, processor.raw_metadata(raw_files, center_weight=True)):
+            print('%s: %dx%d ISO %d shutter speed %f center-weight average RGB %s' % (
+                raw_file, metadata['width'], metadata['height'], metadata['iso'], metadata['shutter_speed'],
+                ' '.join(map(str, metadata['center_rgb']))))
+        print('Read metadata of %d raw files in %f seconds.' % (len(raw_files), time.time() - start))
+        return 0
+
+    if args.serve:
+        import neg_server
+        film_base_rgb = None
+        if args.film_base_raw_file:
+            film_base_rgb = processor.compute_film_base_rgb(args.film_base_raw_file)
+        elif args.film_base_rgb:
+            film_base_rgb = list(map(int, args.film_base_rgb))
+        neg_server.serve(processor, args.port, args.socket, film_base_rgb)
+        return 0
+
+    if args.profile and not processor.catalog.get(args.profile, processor.measurement, processor.camera):
+        profiles = [p['name'] for p in processor.catalog.find(measurement=processor.measurement,
+                                                               camera=processor.camera)]
+        print('No profile %s, available: %s' % (args.profile, ', '.join(profiles)))
+        return 1
+    if not args.profile:
+        if not args.emulsion:
+            print('At least --emulsion needs to be specified!')
+            return 1
+        emulsions = processor.catalog.emulsions(processor.measurement, processor.camera)
+        if args.emulsion.lower() not in emulsions:
+            print('No profiles for emulsion %s, available: %s' % (args.emulsion, ', '.join(emulsions)))
+            return 1
+
+    if args.roll:
+        import neg_batch
+        if not neg_batch.list_raw_files(args.roll, exclude=[args.film_base_raw_file]):
+            print('No raw files in %s' % args.roll)
+            return 1
+
+    selected_film_base_rgb = None
+    if args.film_base_raw_file and args.interactive_mode:
+        import neg_interactive
+        selected_film_base_rgb = neg_interactive.select_film_base_rgb(processor, args.film_base_raw_file)
+
+    if selected_film_base_rgb is None:
+        if args.film_base_raw_file:
+            selected_film_base_rgb = processor.compute_film_base_rgb(args.film_base_raw_file)
+            print('Computed film base RGB %d %d %d (normalized to 1s shutter speed)' % tuple(selected_film_base_rgb))
+        elif args.film_base_rgb:
+            selected_film_base_rgb = list(map(int, args.film_base_rgb))
+            print('Entered film base RGB %d %d %d (normalized to 1s shutter speed)' % tuple(selected_film_base_rgb))
+        elif not args.watch:
+            # Measured from the rebate of the frames, in --watch mode frame by frame as they arrive.
+            if args.roll:
+                import neg_batch
+                raw_files = neg_batch.list_raw_files(args.roll)
+                if args.multi_shot:
+                    raw_files = raw_files[::4]
+            else:
+                raw_files = [args.raw_file]
+            start = time.time()
+            selected_film_base_rgb = processor.measure_film_base(raw_files, args.emulsion, args.profile)
+            if selected_film_base_rgb is None:
+                print('No film base found in the rebate of %d frames, use --film_base_raw_file or'
+                      ' --film_base_rgb.' % len(raw_files))
+                return 1
+            print('Measured film base RGB %d %d %d (normalized to 1s shutter speed) from %d frames in %f seconds' % (
+                tuple(selected_film_base_rgb) + (len(processor.roll_film_base), time.time() - start)))
+
+    # Parameters of each frame in --roll and --watch modes.
+    frame_args = {
+        'emulsion': args.emulsion,
+        'profile_name': args.profile,
+        'exposure_comp': args.exposure_comp,
+        'post_correction_gamma': args.post_correction_gamma,
+        'colorspace': args.colorspace,
+        'scale_down_factor': 2 if args.half_size else (4 if args.quarter_size else 1),
+        'no_crop': args.no_crop,
+        }
+
+    if args.roll:
+        import neg_batch
+        raw_files = neg_batch.list_raw_files(args.roll, exclude=[args.film_base_raw_file])
+        if args.pipeline:
+            process_roll = functools.partial(neg_batch.process_roll_pipelined, queue_size=args.queue_size)
+        else:
+            process_roll = functools.partial(neg_batch.process_roll, jobs=args.jobs)
+        _, failures = process_roll(processor, raw_files, selected_film_base_rgb, **frame_args)
+        return 1 if failures else 0
+
+    if args.watch:
+        import neg_watch
+        neg_watch.watch(processor, args.watch, selected_film_base_rgb, args.queue_size,
+                        settle_time=args.settle_time, exclude=[args.film_base_raw_file], **frame_args)
+        return 0
+
     start = time.time()
-    # cv2 reads the image without caring the embedded ICC profile.
-    # Meanwhile imshow() will display the image assuming they have sRGB curves, at least in OSX.
-    # For this reason apply a srgb output profile for correct brightness of the image displayed.
-    new_profile_name = profile['emulsion'] + ('' if profile_exp == 0 else '%+1d' % profile_exp)
-    new_profile = read_profile_info(new_profile_name)
-    if new_profile and new_profile['name'] != profile['name']:
-        profile = new_profile
-        exp_comp = p_to_scale[profile['name']]
-        slider_exp_comp.set_val(exp_comp)
-        return
-    last_out_path = run_neg_process(args.raw_file, profile, exp_comp, gamma,
-                                    selected_film_base_rgb, 'srgb', 4, False, 'temp.tif')
-    end_neg_process = time.time()
-    out_img = cv2.imread(last_out_path, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH).astype(np.float32) / 65535
-    out_img = cv2.cvtColor(out_img, cv2.COLOR_BGR2RGB)
-    # The image can be shown as-is because it's in sRGB colorspace.
-    ax_img.imshow(out_img, resample=False, filternorm=False)
-    end_neg_process = time.time()
-
-    # TODO: Exclude border.
-    out_img = cv2.resize(out_img, (0, 0), fx = 0.1, fy = 0.1, interpolation = cv2.INTER_LINEAR)
-
-    D50 = colour.CCS_ILLUMINANTS['cie_2_1931']['D50']
-    xyz_img = colour.sRGB_to_XYZ(out_img, illuminant=D50)
-    lab_img = colour.XYZ_to_Lab(xyz_img, illuminant=D50)
-    L, a, b = cv2.split(lab_img)
-    L = L.flatten()
-    a = a.flatten()
-    b = b.flatten()
-    # 2D La*b* histogram.
-    #hist = cv2.calcHist([lab_img], [1, 2], None, [256, 256], [0, 256, 0, 256])
-    #hist = np.power(hist / hist.max(), 0.3)
-
-    # Hack to modify in Lab colorspace.
-    #D65 = colour.CCS_ILLUMINANTS['cie_2_1931']['D65']
-    #xyz = colour.Lab_to_XYZ(cv2.merge([L, a, b + 30]), illuminant=D65)
-    #ax_img.imshow(colour.XYZ_to_sRGB(xyz, illuminant=D65))
-    ax_lab_hist.cla()
-    ax_lab_hist.set_title('a* b* Histogram')
-    ax_lab_hist.set_facecolor("grey")
-    ax_lab_hist.set_xlim([-128, 128])
-    a = 50*a/L
-    b = 50*b/L
-    a_mean = np.mean(a)
-    b_mean = np.mean(b)
-    ax_lab_hist.hist(a, 50, color=('magenta' if a_mean >= 0 else 'green'))
-    ax_lab_hist.hist(b, 50, color=('yellow' if b_mean >= 0 else 'blue'))
-    ax_lab_hist.axvline(a_mean, color=('magenta' if a_mean >= 0 else 'green'), linestyle='dashed', linewidth=1)
-    ax_lab_hist.axvline(b_mean, color=('yellow' if b_mean >= 0 else 'blue'), linestyle='dashed', linewidth=1)
-    ax_lab_hist.text(a_mean + 3, 0.9, str(round(a_mean, 2)), transform=ax_lab_hist.get_xaxis_transform(), color='magenta')
-    ax_lab_hist.text(b_mean + 3, 0.8, str(round(b_mean, 2)), transform=ax_lab_hist.get_xaxis_transform(), color='yellow')
-    ax_lab_hist.tick_params(axis="y", labelsize=5)
-
-    l_mean = L.mean()
-    ax_l_hist.cla()
-    ax_l_hist.set_title('L* Histogram')
-    ax_l_hist.axvline(l_mean, color='black', linestyle='dashed', linewidth=1)
-    ax_l_hist.text(l_mean + 3, 0.9, str(round(l_mean, 2)), transform=ax_l_hist.get_xaxis_transform(), color='red')
-    ax_l_hist.hist(L, 50, (0, 100), color='grey')
-    end = time.time()
-    print('Process time %f Show time %f' % (end_neg_process - start, end - start))
-
-def update_exp_comp(val):
-    global exp_comp
-    exp_comp = val
-    reprocess_and_show_image()
-    pass
-
-def update_gamma(val):
-    global gamma
-    gamma = val
-    reprocess_and_show_image()
-    pass
-def update_profile(val):
-    global profile_exp
-    exp = int(val)
-    if exp != profile['exp']:
-        profile_exp = exp
-        reprocess_and_show_image()
-
-slider_exp_comp.on_changed(update_exp_comp)
-slider_gamma.on_changed(update_gamma)
-slider_profile.on_changed(update_profile)
-
-reprocess_and_show_image()
-plt.show()
-
-print('Gamma %f' % gamma)
-print('Exposure comp %f' % exp_comp)
-print('Profile used %s' % profile['name'])
-
-os.remove(last_out_path)
-out_file = run_neg_process(args.raw_file, profile, exp_comp, gamma,
-                selected_film_base_rgb, args.colorspace, 2 if args.half_size else (4 if args.quarter_size else 1), args.no_crop,
-                Path(args.raw_file).stem + '.pos.tif')
-print('Done %s' % out_file)
-
-# TODO: Write parameters for debugging.
+    profile, p_to_scale, exp_map = processor.select_profile(args.raw_file, selected_film_base_rgb,
+                                                            args.emulsion, args.profile)
+    print("Chosen profile %s in %f seconds with shutter speed %f." % (profile['name'], time.time() - start, profile['shutter_speed']))
+
+    exp_comp = args.exposure_comp if args.exposure_comp else p_to_scale[profile['name']]
+
+    if not args.interactive_mode:
+        out_file = processor.export(args.raw_file, profile, exp_comp, args.post_correction_gamma, selected_film_base_rgb, args.colorspace, 2 if args.half_size else (4 if args.quarter_size else 1), args.no_crop)
+        print('Done %s' % out_file)
+        return 0
+
+    import neg_interactive
+    out_file = neg_interactive.run(processor, args, profile, p_to_scale, exp_map, exp_comp, selected_film_base_rgb)
+    print('Done %s' % out_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
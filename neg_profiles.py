@@ -0,0 +1,179 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Catalog of the profiles in icc_out. build_prof.py writes for each profile
+# '<camera> <Name> <measurement> Info.txt' next to the ICC profiles
+# '<camera> <Name> <measurement> <type>.icc', where Name is the emulsion followed
+# by the exposure offset in stops, e.g. 'Sony A7RM4 Portra400+1 R190808 Info.txt'.
+#
+# The Info.txt files are parsed once into an index file in CACHE_DIR. When the
+# catalog is loaded only the files added, removed or modified since the index was
+# written are parsed again, so a large profile library is cheap to load.
+
+import hashlib
+import json
+import os
+from neg_render import CACHE_DIR, atomic_write
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icc_out')
+
+INFO_SUFFIX = ' Info.txt'
+
+# Format of the index, an index in another format is rebuilt.
+INDEX_VERSION = 1
+
+
+def parse_profile_name(name):
+    '''Returns the emulsion and the exposure offset of the profile |name|, e.g.
+    ('portra400', 1) for 'portra400+1'.'''
+    if len(name) > 2 and name[-2] in ['+', '-'] and name[-1].isdigit():
+        return name[:-2], int(name[-2:])
+    return name, 0
+
+
+def read_info(info_txt):
+    '''Parses the Info.txt written by build_prof.py.'''
+    with open(info_txt) as f:
+        matrix = []
+        for i in range(0, 3):
+            coeffs = f.readline().strip('\r\n').split(' ')[0:3]
+            matrix.append(list(map(float, coeffs)))
+        shutter_speed = f.readline().strip('\r\n').split(' ')[0]
+        film_base_rgb = f.readline().strip('\r\n').split(' ')[0:3]
+        f.readline() # Min
+        f.readline() # Max
+        mean_rgb = f.readline().strip('\r\n').split(' ')[0:3] # Mean
+        mid_grey_rgb = f.readline().strip('\r\n').split(' ')[0:3] # Mid-grey
+    return {
+        'matrix': matrix,
+        'shutter_speed': float(shutter_speed),
+        'film_base_rgb': list(map(int, film_base_rgb)),
+        'mean_rgb': list(map(float, mean_rgb)),
+        'mid_grey_rgb': list(map(float, mid_grey_rgb)),
+        }
+
+
+class ProfileCatalog:
+    '''Index of the profiles in |directory|. Use catalog() to get the catalog loaded
+    once per process.'''
+
+    def __init__(self, directory=PROFILE_DIR, index_file=None):
+        self.directory = os.path.realpath(directory)
+        self.index_file = index_file or os.path.join(
+            CACHE_DIR, 'profiles-%s.json' % hashlib.sha1(self.directory.encode()).hexdigest()[:16])
+        # Info.txt file name -> {'mtime_ns': ..., 'profile': ...}
+        self._entries = {}
+        # (camera, measurement, name) -> profile
+        self._profiles = {}
+        self.load()
+
+    def load(self):
+        '''Brings the index up to date with the directory. Returns the number of Info.txt
+        files parsed.'''
+        entries = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index.get('version') == INDEX_VERSION:
+                    entries = index['entries']
+            except (OSError, ValueError, KeyError):
+                entries = {}
+        # ICC profiles by (camera, Name, measurement).
+        icc_files = {}
+        info_files = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(INFO_SUFFIX):
+                    info_files[entry.name] = entry.stat().st_mtime_ns
+                elif entry.name.endswith('.icc'):
+                    fields = entry.name[:-len('.icc')].rsplit(' ', 3)
+                    if len(fields) == 4:
+                        icc_files.setdefault(tuple(fields[:3]), {})[fields[3]] = entry.name
+        parsed = 0
+        changed = set(entries) != set(info_files)
+        for file_name, mtime_ns in info_files.items():
+            entry = entries.get(file_name)
+            if entry and entry['mtime_ns'] == mtime_ns:
+                continue
+            fields = file_name[:-len(INFO_SUFFIX)].rsplit(' ', 2)
+            if len(fields) != 3:
+                continue
+            camera, name, measurement = fields
+            try:
+                profile = read_info(os.path.join(self.directory, file_name))
+            except (OSError, ValueError, IndexError) as e:
+                print('Skipping profile %s: %s' % (file_name, e))
+                continue
+            emulsion, exp = parse_profile_name(name.lower())
+            profile.update({
+                'exp': exp,
+                'emulsion': emulsion,
+                'name': name.lower(),
+                'camera': camera,
+                'measurement': measurement,
+                })
+            entries[file_name] = {'mtime_ns': mtime_ns, 'profile': profile}
+            parsed += 1
+            changed = True
+        self._entries = {k: v for k, v in entries.items() if k in info_files}
+        self._profiles = {}
+        for file_name, entry in self._entries.items():
+            profile = entry['profile']
+            camera, name, measurement = file_name[:-len(INFO_SUFFIX)].rsplit(' ', 2)
+            # ICC profiles are listed every time, they are built after the Info.txt.
+            profile['icc_paths'] = {
+                profile_type: os.path.join(self.directory, icc_file)
+                for profile_type, icc_file in icc_files.get((camera, name, measurement), {}).items()}
+            self._profiles[(profile['camera'], profile['measurement'], profile['name'])] = profile
+        if changed:
+            self._save()
+        return parsed
+
+    def _save(self):
+        with atomic_write(self.index_file, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'directory': self.directory, 'entries': self._entries},
+                      f, separators=(',', ':'))
+
+    def get(self, name, measurement, camera):
+        '''Returns a copy of the profile |name|, e.g. 'portra400+1', or None.'''
+        profile = self._profiles.get((camera, measurement, name.lower()))
+        return dict(profile) if profile else None
+
+    def find(self, emulsion=None, exp=None, measurement=None, camera=None):
+        '''Returns copies of the profiles matching all the arguments given, sorted by
+        camera, measurement, emulsion and exposure offset.'''
+        profiles = [
+            p for p in self._profiles.values()
+            if (emulsion is None or p['emulsion'] == emulsion.lower()) and
+            (exp is None or p['exp'] == exp) and
+            (measurement is None or p['measurement'] == measurement) and
+            (camera is None or p['camera'] == camera)]
+        return [dict(p) for p in sorted(profiles, key=lambda p: (p['camera'], p['measurement'],
+                                                                 p['emulsion'], p['exp']))]
+
+    def emulsions(self, measurement=None, camera=None):
+        return sorted(set(p['emulsion'] for p in self.find(measurement=measurement, camera=camera)))
+
+
+# Catalogs loaded by this process by directory.
+_catalogs = {}
+
+def catalog(directory=PROFILE_DIR):
+    '''Returns the catalog of |directory|, loaded once per process.'''
+    directory = os.path.realpath(directory)
+    if directory not in _catalogs:
+        _catalogs[directory] = ProfileCatalog(directory)
+    return _catalogs[directory]
@@ -0,0 +1,622 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# In-process version of the post-decode steps of bin_out/neg_process.
+#
+# The binary decodes the RAW file, applies the correction matrix, the post
+# correction gamma and the ICC transform and then writes a TIFF. For the
+# interactive mode only the last three steps depend on the parameters chosen by
+# the user, so the RAW file is decoded once into linear RGB and the rest of the
+# pipeline is done here with NumPy and LittleCMS (through ctypes, lcms2 is
+# already needed to build the binary).
+
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import numpy as np
+
+# Directory for data derived from the profiles and RAW files that can be reused between runs.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'negicc')
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    '''Returns a context manager of a file opened with |mode| that replaces |path| when
+    closed. It is written under a unique temporary name in the same directory so other
+    processes and threads never read a partial file. On error |path| is left as it was.'''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(mode, dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(f.name)
+        raise
+
+# LittleCMS constants, see lcms2.h.
+TYPE_RGB_16 = (4 << 16) | (3 << 3) | 2  # COLORSPACE_SH(PT_RGB) | CHANNELS_SH(3) | BYTES_SH(2)
+INTENT_PERCEPTUAL = 0
+
+_lcms = None
+
+
+def _lcms2():
+    global _lcms
+    if _lcms is None:
+        path = ctypes.util.find_library('lcms2')
+        if not path:
+            raise RuntimeError('Cannot find liblcms2, see Requirements in README.md.')
+        lib = ctypes.CDLL(path)
+        lib.cmsOpenProfileFromFile.restype = ctypes.c_void_p
+        lib.cmsOpenProfileFromFile.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
+        lib.cmsOpenProfileFromMem.restype = ctypes.c_void_p
+        lib.cmsOpenProfileFromMem.argtypes = [ctypes.c_char_p, ctypes.c_uint32]
+        lib.cmsCloseProfile.argtypes = [ctypes.c_void_p]
+        lib.cmsCreateTransform.restype = ctypes.c_void_p
+        lib.cmsCreateTransform.argtypes = [ctypes.c_void_p, ctypes.c_uint32,
+                                           ctypes.c_void_p, ctypes.c_uint32,
+                                           ctypes.c_uint32, ctypes.c_uint32]
+        lib.cmsDeleteTransform.argtypes = [ctypes.c_void_p]
+        lib.cmsDoTransform.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                       ctypes.c_void_p, ctypes.c_uint32]
+        _lcms = lib
+    return _lcms
+
+
+def read_elle_profile(name):
+    '''Returns the bytes of an elle ICC profile compiled into bin_out/neg_process,
+    e.g. name = "sRGB_elle_V2_srgbtrc".'''
+    header = os.path.join(os.path.dirname(__file__), '3rd_party', 'elle_icc_profiles', name + '.h')
+    with open(header) as f:
+        body = f.read().split('{', 1)[1].split('}', 1)[0]
+    return bytes(int(x, 16) for x in re.findall(r'0x[0-9a-fA-F]{2}', body))
+
+
+def read_profile_data(profile):
+    '''Returns the bytes of an ICC profile named like in open_profile().'''
+    if profile in ('srgb', 'srgb-g10'):
+        return read_elle_profile('sRGB_elle_V2_srgbtrc' if profile == 'srgb' else 'sRGB_elle_V2_g10')
+    with open(profile, 'rb') as f:
+        return f.read()
+
+
+def open_profile(profile):
+    '''Opens an ICC profile using the same names accepted by -P of bin_out/neg_process:
+    srgb, srgb-g10 or a path to an ICC profile.'''
+    lib = _lcms2()
+    if profile in ('srgb', 'srgb-g10'):
+        data = read_elle_profile('sRGB_elle_V2_srgbtrc' if profile == 'srgb' else 'sRGB_elle_V2_g10')
+        handle = lib.cmsOpenProfileFromMem(data, len(data))
+    else:
+        handle = lib.cmsOpenProfileFromFile(profile.encode(), b'r')
+    if not handle:
+        raise RuntimeError('Cannot read ICC profile: %s' % profile)
+    return handle
+
+
+class ColorTransform:
+    '''A LittleCMS transform between two ICC profiles operating on 16-bit RGB.'''
+
+    def __init__(self, input_profile, output_profile):
+        lib = _lcms2()
+        in_profile = open_profile(input_profile)
+        out_profile = open_profile(output_profile)
+        self._transform = lib.cmsCreateTransform(in_profile, TYPE_RGB_16, out_profile,
+                                                 TYPE_RGB_16, INTENT_PERCEPTUAL, 0)
+        # The transform keeps its own copy of what is needed from the profiles.
+        lib.cmsCloseProfile(in_profile)
+        lib.cmsCloseProfile(out_profile)
+        if not self._transform:
+            raise RuntimeError('Cannot create transform from %s to %s' % (input_profile, output_profile))
+
+    def apply(self, img):
+        '''Transform |img|, a contiguous H x W x 3 uint16 array, in place.'''
+        assert img.dtype == np.uint16 and img.flags['C_CONTIGUOUS']
+        pixels = img.shape[0] * img.shape[1]
+        _lcms2().cmsDoTransform(self._transform, img.ctypes.data, img.ctypes.data, pixels)
+        return img
+
+    def __del__(self):
+        if getattr(self, '_transform', None):
+            _lcms2().cmsDeleteTransform(self._transform)
+            self._transform = None
+
+
+class BakedTransform:
+    '''A ColorTransform baked into a 3D LUT applied with tetrahedral interpolation.
+
+    Inputs are mapped to the grid through a power shaper, x = (v / 65535) ** (1 / 2.2),
+    so that nodes are denser in the shadows where the curves of the film profiles
+    are steep. The LUTs are cached in CACHE_DIR by ICC profile, its modification time,
+    output colorspace and grid size.
+
+    Accuracy: when baked, the LUT is compared with the exact LittleCMS transform on
+    LUT_VALIDATION_SAMPLES random 16-bit inputs. For 99.9% of them the error of every
+    channel has to be within MAX_LUT_ERROR (256, i.e. one 8-bit level), otherwise
+    bake() returns None and the exact transform should be used. The largest errors
+    are where the transform clips out of gamut colors, which the LUT smooths over
+    one grid cell. With a synthetic cLUT film profile to sRGB the 65^3 LUT has a
+    mean error of 5, 99.9% within 170 and is 3 times faster than LittleCMS.'''
+
+    LUT_SIZE = 65
+    SHAPER_GAMMA = 2.2
+    MAX_LUT_ERROR = 256
+    MAX_LUT_ERROR_PERCENTILE = 99.9
+    LUT_VALIDATION_SAMPLES = 100000
+    # Pixels interpolated at once, bounds the temporary arrays to about 100 MB.
+    CHUNK_PIXELS = 1 << 20
+
+    def __init__(self, lut):
+        size = lut.shape[0]
+        self._size = size
+        self._lut = lut.reshape(-1, 3)
+        # Grid coordinate of each 16-bit input.
+        self._shaper = ((np.arange(0x10000, dtype=np.float64) / 0xffff) ** (1.0 / self.SHAPER_GAMMA) *
+                        (size - 1)).astype(np.float32)
+        # Offsets in the flattened LUT of one step along R, G and B.
+        self._strides = [size * size, size, 1]
+        # The cube around an input is split into 6 tetrahedra by the order of the fractional
+        # parts of the R, G and B grid coordinates. The steps from the base corner to the
+        # opposite corner along the axes in descending order of the fractions are indexed
+        # by (fr >= fg) * 4 + (fg >= fb) * 2 + (fr >= fb).
+        self._steps = np.zeros((3, 8), dtype=np.intp)
+        for order in itertools.permutations(range(3)):
+            rank = [0, 0, 0]
+            for i, axis in enumerate(order):
+                rank[axis] = 3 - i
+            case = (rank[0] >= rank[1]) * 4 + (rank[1] >= rank[2]) * 2 + (rank[0] >= rank[2])
+            self._steps[:, case] = [self._strides[axis] for axis in order]
+
+    @classmethod
+    def bake(cls, input_profile, output_profile, size=None):
+        '''Returns the BakedTransform between two ICC profiles, or None if the LUT isn't
+        accurate enough.'''
+        size = size or cls.LUT_SIZE
+        st = os.stat(input_profile)
+        key = hashlib.sha1(repr((os.path.realpath(input_profile), st.st_size, st.st_mtime_ns,
+                                 output_profile, size, cls.SHAPER_GAMMA)).encode()).hexdigest()
+        lut_npz = os.path.join(CACHE_DIR, 'luts', key + '.npz')
+        if os.path.exists(lut_npz):
+            with np.load(lut_npz) as data:
+                lut, errors = data['lut'], data['errors']
+        else:
+            lut, errors = cls._bake(ColorTransform(input_profile, output_profile), size)
+            print('Baked %d^3 LUT for %s, error mean %.1f, %.1f%% within %.1f, max %.1f' % (
+                size, os.path.basename(input_profile), errors[0], cls.MAX_LUT_ERROR_PERCENTILE,
+                errors[1], errors[2]))
+            with atomic_write(lut_npz) as f:
+                np.savez(f, lut=lut, errors=errors)
+        if errors[1] > cls.MAX_LUT_ERROR:
+            return None
+        return cls(lut)
+
+    @classmethod
+    def _bake(cls, transform, size):
+        '''Returns the LUT and the mean, percentile and max of its error compared with |transform|.'''
+        nodes = np.round((np.linspace(0, 1, size) ** cls.SHAPER_GAMMA) * 0xffff).astype(np.uint16)
+        grid = np.stack(np.meshgrid(nodes, nodes, nodes, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+        lut = transform.apply(np.ascontiguousarray(grid)).reshape(size, size, size, 3).astype(np.float32)
+        samples = np.random.default_rng(0).integers(
+            0, 0x10000, (cls.LUT_VALIDATION_SAMPLES, 1, 3), dtype=np.uint16)
+        exact = transform.apply(samples.copy()).astype(np.int32)
+        approx = cls(lut).apply(samples).astype(np.int32)
+        error = np.abs(exact - approx).max(axis=-1)
+        return lut, np.array([error.mean(), np.percentile(error, cls.MAX_LUT_ERROR_PERCENTILE), error.max()])
+
+    def apply(self, img):
+        '''Transform |img|, a contiguous H x W x 3 uint16 array, in place.'''
+        assert img.dtype == np.uint16 and img.flags['C_CONTIGUOUS']
+        pixels = img.reshape(-1, 3)
+        for start in range(0, len(pixels), self.CHUNK_PIXELS):
+            chunk = pixels[start:start + self.CHUNK_PIXELS]
+            chunk[:] = self._interpolate(chunk)
+        return img
+
+    def _interpolate(self, rgb):
+        index = np.zeros(len(rgb), dtype=np.intp)
+        fracs = []
+        for c in range(3):
+            coord = self._shaper[rgb[:, c]]
+            base = np.minimum(coord.astype(np.intp), self._size - 2)
+            fracs.append(coord - base)
+            index += base * self._strides[c]
+        fr, fg, fb = fracs
+        case = (fr >= fg).view(np.uint8) * np.uint8(4)
+        case += (fg >= fb).view(np.uint8) * np.uint8(2)
+        case += (fr >= fb).view(np.uint8)
+        f_max = np.maximum(np.maximum(fr, fg), fb)
+        f_min = np.minimum(np.minimum(fr, fg), fb)
+        f_mid = fr + fg + fb - f_max - f_min
+        # Weights of the 4 corners of the tetrahedron from the base corner.
+        out = np.take(self._lut, index, axis=0) * (1 - f_max)[:, np.newaxis]
+        index += np.take(self._steps[0], case)
+        out += np.take(self._lut, index, axis=0) * (f_max - f_mid)[:, np.newaxis]
+        index += np.take(self._steps[1], case)
+        out += np.take(self._lut, index, axis=0) * (f_mid - f_min)[:, np.newaxis]
+        index += np.take(self._steps[2], case)
+        out += np.take(self._lut, index, axis=0) * f_min[:, np.newaxis]
+        out += 0.5
+        return np.clip(out, 0, 0xffff).astype(np.uint16)
+
+
+def gamma_curve(gamma):
+    '''Same as gamma_curve() from dcraw with zero toe slope as used by
+    bin_out/neg_process. Returns a 16-bit lookup table.'''
+    if not gamma > 0:
+        raise ValueError('Gamma must be greater than 0, got %s' % gamma)
+    r = np.arange(0x10000, dtype=np.float64) / 0xffff
+    curve = (0x10000 * np.power(r, 1.0 / gamma)).astype(np.uint32)
+    curve[-1] = 0xffff
+    return np.minimum(curve, 0xffff).astype(np.uint16)
+
+
+def adjust_correction_matrix(matrix, exposure_comp, profile_film_base_rgb, film_base_rgb):
+    '''Returns the crosstalk correction |matrix| scaled to compensate the film base
+    difference between the profile and the captured film, and by |exposure_comp|.
+    See adjust_correction_matrix() in neg_process.cc for details.'''
+    matrix = np.array(matrix, dtype=np.float64)
+    cc_average = np.matmul(matrix, film_base_rgb)
+    cc_profile = np.matmul(matrix, profile_film_base_rgb)
+    channel_scale = (cc_profile / cc_profile[0]) / (cc_average / cc_average[0])
+    return matrix * (channel_scale * exposure_comp)[:, np.newaxis]
+
+
+def box_reduce(img, factor):
+    '''Returns the H x W x C |img| reduced by |factor| by averaging blocks of factor x factor
+    pixels, in the same dtype. Rows and columns that don't fill a block are dropped.'''
+    if factor == 1:
+        return img
+    h, w, c = img.shape
+    h, w = h // factor, w // factor
+    reduced = img[:h * factor, :w * factor].reshape(h, factor, w, factor, c).mean(axis=(1, 3), dtype=np.float32)
+    if np.issubdtype(img.dtype, np.integer):
+        # Round to nearest.
+        return (reduced + 0.5).astype(img.dtype)
+    return reduced
+
+
+class PreviewRenderer:
+    '''Renders images from linear (uncorrected) RGB decoded once from a RAW file.
+
+    Transforms are created once for each input ICC profile and reused for
+    subsequent renders. |transforms| can be passed to share them between renderers
+    with the same colorspace. If |baked| is set the ICC transforms are done with
+    BakedTransform where it's accurate enough.'''
+
+    def __init__(self, linear_img, colorspace='srgb', transforms=None, baked=False):
+        # None for a renderer only used by render_strips().
+        self.linear_img = None if linear_img is None else np.ascontiguousarray(linear_img, dtype=np.float32)
+        self.colorspace = colorspace
+        self.baked = baked
+        self._transforms = {} if transforms is None else transforms
+        self._gamma_curves = {}
+
+    def downscaled(self, factor):
+        '''Returns a renderer for this image reduced by |factor| with a box filter.
+        Transforms are shared with this renderer.'''
+        renderer = PreviewRenderer(box_reduce(self.linear_img, factor), self.colorspace, self._transforms,
+                                   self.baked)
+        renderer._gamma_curves = self._gamma_curves
+        return renderer
+
+    def _transform(self, icc_path):
+        key = (icc_path, self.baked)
+        if key not in self._transforms:
+            transform = BakedTransform.bake(icc_path, self.colorspace) if self.baked else None
+            self._transforms[key] = transform or ColorTransform(icc_path, self.colorspace)
+        return self._transforms[key]
+
+    def _gamma_curve(self, gamma):
+        if gamma not in self._gamma_curves:
+            self._gamma_curves.clear()
+            self._gamma_curves[gamma] = gamma_curve(gamma)
+        return self._gamma_curves[gamma]
+
+    def render(self, matrix, icc_path, exposure_comp, post_correction_gamma,
+               profile_film_base_rgb, film_base_rgb, cancelled=None):
+        '''Returns a H x W x 3 uint16 image in the output colorspace.
+
+        |cancelled| is checked between the stages of the pipeline, if it returns
+        True the render is abandoned and None is returned.'''
+        return self._render(self.linear_img, matrix, icc_path, exposure_comp, post_correction_gamma,
+                            profile_film_base_rgb, film_base_rgb, cancelled or (lambda: False))
+
+    def render_strips(self, strips, matrix, icc_path, exposure_comp, post_correction_gamma,
+                      profile_film_base_rgb, film_base_rgb):
+        '''Renders |strips|, linear images of N x W x 3 rows, one by one the same way as
+        render() and yields the uint16 strips. The image of this renderer isn't used so
+        only one strip at a time is in memory.'''
+        for strip in strips:
+            yield self._render(np.asarray(strip, dtype=np.float32), matrix, icc_path, exposure_comp,
+                               post_correction_gamma, profile_film_base_rgb, film_base_rgb, lambda: False)
+
+    def _render(self, linear_img, matrix, icc_path, exposure_comp, post_correction_gamma,
+                profile_film_base_rgb, film_base_rgb, cancelled):
+        mat = adjust_correction_matrix(matrix, exposure_comp, profile_film_base_rgb, film_base_rgb)
+        corrected = np.matmul(linear_img, mat.T.astype(np.float32))
+        # Round and clip the same way as post_process() in neg_process.cc.
+        corrected += 0.5
+        np.clip(corrected, 0, 65535, out=corrected)
+        img = corrected.astype(np.uint16)
+        if cancelled():
+            return None
+        if post_correction_gamma != 1.0:
+            img = self._gamma_curve(post_correction_gamma)[img]
+        if cancelled():
+            return None
+        if icc_path and self.colorspace:
+            self._transform(icc_path).apply(img)
+        return img
+
+
+def srgb_to_lab_lut(size):
+    '''Returns a size x size x size x 3 float32 LUT of D50 Lab values for sRGB values
+    quantized to |size| levels. The LUT is cached in CACHE_DIR.'''
+    lut_npy = os.path.join(CACHE_DIR, 'srgb_to_lab_d50_%d.npy' % size)
+    if os.path.exists(lut_npy):
+        return np.load(lut_npy)
+    # Only needed to build the LUT and slow to import.
+    import colour
+    D50 = colour.CCS_ILLUMINANTS['cie_2_1931']['D50']
+    grid = np.linspace(0, 1, size)
+    rgb = np.stack(np.meshgrid(grid, grid, grid, indexing='ij'), axis=-1)
+    lut = colour.XYZ_to_Lab(colour.sRGB_to_XYZ(rgb, illuminant=D50), illuminant=D50).astype(np.float32)
+    with atomic_write(lut_npy) as f:
+        np.save(f, lut)
+    return lut
+
+
+class LabHistogram:
+    '''Computes the L* histogram and the a* and b* (scaled by 50 / L*) histograms
+    of sRGB images with a quantized sRGB to Lab LUT.
+
+    The histograms are normalized to fractions of pixels.'''
+
+    def __init__(self, ab_bins, l_bins, lut_size=64):
+        # Bins are expected to be evenly spaced, e.g. from np.linspace().
+        self._ab_bins = ab_bins
+        self._l_bins = l_bins
+        self._lut_size = lut_size
+        self._lut = srgb_to_lab_lut(lut_size)
+
+    @staticmethod
+    def _bin_index(x, bins):
+        n = len(bins) - 1
+        # Values outside of the bins are dropped and the last bin includes the right
+        # edge like np.histogram().
+        x = x[(x >= bins[0]) & (x <= bins[-1])]
+        idx = ((x - np.float32(bins[0])) * np.float32(n / (bins[-1] - bins[0]))).astype(np.intp)
+        return np.minimum(idx, n - 1)
+
+    def compute(self, img, stride=1):
+        '''|img| is a H x W x 3 sRGB image with values from 0 to 1. Only every
+        |stride|-th row and column is used.'''
+        img = img[::stride, ::stride]
+        idx = (img * np.float32(self._lut_size - 1) + np.float32(0.5)).astype(np.intp)
+        lab = self._lut[idx[..., 0], idx[..., 1], idx[..., 2]].reshape(-1, 3)
+        L = lab[:, 0]
+        scale = np.float32(50) / np.maximum(L, np.float32(1e-3))
+        a = lab[:, 1] * scale
+        b = lab[:, 2] * scale
+        n_ab = len(self._ab_bins) - 1
+        n_l = len(self._l_bins) - 1
+        # Accumulate the three histograms with a single bincount().
+        bin_idx = np.concatenate([self._bin_index(a, self._ab_bins),
+                                  self._bin_index(b, self._ab_bins) + n_ab,
+                                  self._bin_index(L, self._l_bins) + 2 * n_ab])
+        counts = np.bincount(bin_idx, minlength=2 * n_ab + n_l).astype(np.float32) / len(L)
+        return {
+            'a_hist': counts[:n_ab],
+            'b_hist': counts[n_ab:2 * n_ab],
+            'l_hist': counts[2 * n_ab:],
+            'a_mean': float(np.mean(a)),
+            'b_mean': float(np.mean(b)),
+            'l_mean': float(np.mean(L)),
+        }
+
+
+class PreviewCache:
+    '''LRU cache of rendered previews, bounded by the total size of the NumPy arrays
+    held in the cached values.'''
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (tuple, list)):
+            return sum(PreviewCache._size(v) for v in value)
+        if isinstance(value, dict):
+            return sum(PreviewCache._size(v) for v in value.values())
+        return 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self._size(value)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+
+class DecodeCache:
+    '''On-disk cache of decoded linear images shared by all runs and processes.
+
+    Images are stored as .npy files in |directory| and returned memory-mapped
+    read-only, so processes using the same decode share the pages instead of
+    decoding or copying again. Files are evicted in least recently used order,
+    using their modification time which is updated on each hit, once the total
+    size exceeds |max_bytes|.'''
+
+    def __init__(self, max_bytes, directory=os.path.join(CACHE_DIR, 'decoded')):
+        self.max_bytes = max_bytes
+        self.directory = directory
+
+    @staticmethod
+    def key(raw_file, **params):
+        '''Returns the key of the decode of |raw_file| with |params|. The file is identified
+        by its path, size and modification time so a modified file is decoded again.'''
+        st = os.stat(raw_file)
+        identity = (os.path.realpath(raw_file), st.st_size, st.st_mtime_ns, sorted(params.items()))
+        return hashlib.sha1(repr(identity).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            img = np.load(path, mmap_mode='r')
+            # Mark as recently used.
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return img
+
+    def put(self, key, img):
+        '''Stores |img| and returns it memory-mapped from the cache.'''
+        if img.nbytes > self.max_bytes:
+            return img
+        path = self._path(key)
+        with atomic_write(path) as f:
+            np.save(f, np.ascontiguousarray(img))
+        self._evict()
+        return self.get(key) if os.path.exists(path) else img
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                # Evicted by another process.
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        # Mapped files stay readable after removal, at least on POSIX.
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class RenderScheduler:
+    '''Runs renders on a worker thread, only the most recent request matters.
+
+    Requests arriving within |debounce| seconds of the first pending one (e.g.
+    from dragging a slider) are merged into a single render of the latest
+    parameters. A render in progress is abandoned once a newer request is
+    submitted, and poll() only returns the result of the latest request.
+
+    Each request is rendered progressively in |levels| levels. Level 0 is
+    rendered right away and each following level is rendered after no new
+    request has arrived for |refine_delay| seconds.
+
+    |render| is called as render(params, level, cancelled) on the worker thread
+    and should return None when cancelled() becomes True. Exceptions raised by
+    |render| are printed and the request gets no result.'''
+
+    def __init__(self, render, debounce=0.03, levels=1, refine_delay=0.3):
+        self._render = render
+        self._debounce = debounce
+        self._levels = levels
+        self._refine_delay = refine_delay
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._result = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, params):
+        with self._cond:
+            self._generation += 1
+            self._pending = (self._generation, params)
+            self._cond.notify()
+
+    def poll(self):
+        '''Returns (params, result) of the latest request if it has finished rendering,
+        otherwise None. Supposed to be called from the UI thread.'''
+        with self._cond:
+            result, self._result = self._result, None
+            if result is None or result[0] != self._generation:
+                return None
+        return result[1], result[2]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                deadline = time.time() + self._debounce
+                while time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                generation, params = self._pending
+                self._pending = None
+            for level in range(self._levels):
+                if level > 0:
+                    with self._cond:
+                        deadline = time.time() + self._refine_delay
+                        while time.time() < deadline and generation == self._generation:
+                            self._cond.wait(deadline - time.time())
+                if generation != self._generation:
+                    break
+                try:
+                    result = self._render(params, level, lambda: generation != self._generation)
+                except Exception:
+                    # Keep the thread for the next request.
+                    print('Render failed:')
+                    traceback.print_exc()
+                    break
+                with self._cond:
+                    if result is not None and generation == self._generation:
+                        self._result = (generation, params, result)
@@ -0,0 +1,228 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Server mode of neg_process.py. Conversion jobs are accepted over HTTP on
+# localhost or on a Unix socket and run by one NegativeProcessor, so the parsed
+# profiles and ICC transforms stay in memory between jobs.
+#
+# POST /jobs with a JSON object queues a job, e.g.
+#   {"raw_file": "/scans/frame.ARW", "emulsion": "portra400", "film_base_rgb": [7000, 3500, 1900]}
+# Other fields are profile, film_base_raw_file, exposure_comp, post_correction_gamma,
+# colorspace, size ("full", "half" or "quarter"), no_crop and out_file. Without a film
+# base the film base is measured from the rebate of the frames. Add ?wait=1
+# to return when the job is done. GET /jobs/<id> returns the status and timing of a
+# job and GET /jobs returns all jobs. Only the last MAX_FINISHED_JOBS finished jobs
+# are kept so a long running server doesn't grow.
+#
+#   curl --unix-socket /tmp/negicc.sock -d '{"raw_file": ...}' 'http://localhost/jobs?wait=1'
+
+import collections
+import http.server
+import itertools
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+import urllib.parse
+import neg_batch
+
+SCALE_DOWN_FACTORS = {'full': 1, 'half': 2, 'quarter': 4}
+
+# Number of done or failed jobs kept for GET /jobs, older ones are forgotten.
+MAX_FINISHED_JOBS = 1000
+
+
+class JobQueue:
+    '''Runs conversion jobs in order on |workers| threads sharing |processor|. Only
+    the last |max_finished| done or failed jobs are kept.'''
+
+    def __init__(self, processor, film_base_rgb=None, workers=1, max_finished=MAX_FINISHED_JOBS):
+        self._processor = processor
+        # Used by jobs that specify neither film_base_rgb nor film_base_raw_file.
+        self._film_base_rgb = film_base_rgb
+        self._jobs = {}
+        # Ids of the done or failed jobs in the order they finished.
+        self._finished = collections.deque()
+        self._max_finished = max_finished
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        for i in range(workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, params):
+        '''Validates |params| and queues the job. Returns the status of the job.'''
+        if not params.get('raw_file'):
+            raise ValueError('raw_file is required')
+        if not params.get('profile') and not params.get('emulsion'):
+            raise ValueError('profile or emulsion is required')
+        if params.get('size', 'full') not in SCALE_DOWN_FACTORS:
+            raise ValueError('size must be one of %s' % ', '.join(SCALE_DOWN_FACTORS))
+        with self._lock:
+            job = {
+                'id': next(self._ids),
+                'status': 'queued',
+                'params': params,
+                'submit_time': time.time(),
+                }
+            self._jobs[job['id']] = job
+        self._queue.put(job)
+        return self.status(job['id'])
+
+    def status(self, job_id):
+        '''Returns a copy of the job |job_id| or None if there's no such job.'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def wait(self, job_id):
+        '''Waits until the job |job_id| is done or failed and returns its status, or None
+        if there's no such job.'''
+        with self._done:
+            job = self._jobs.get(job_id)
+            if not job:
+                return None
+            # The job is still returned if it's forgotten while waiting.
+            self._done.wait_for(lambda: job['status'] in ['done', 'failed'])
+            return dict(job)
+
+    def _update(self, job, **kwargs):
+        with self._done:
+            job.update(kwargs)
+            if job['status'] in ['done', 'failed']:
+                self._finished.append(job['id'])
+                while len(self._finished) > self._max_finished:
+                    del self._jobs[self._finished.popleft()]
+            self._done.notify_all()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            start = time.time()
+            self._update(job, status='running', queue_time=start - job['submit_time'])
+            params = job['params']
+            try:
+                if params.get('film_base_rgb'):
+                    film_base_rgb = list(map(int, params['film_base_rgb']))
+                elif params.get('film_base_raw_file'):
+                    film_base_rgb = self._processor.compute_film_base_rgb(params['film_base_raw_file'])
+                elif self._film_base_rgb:
+                    film_base_rgb = self._film_base_rgb
+                else:
+                    # Combined with the rebate of the frames of earlier jobs.
+                    film_base_rgb = self._processor.measure_film_base(
+                        [params['raw_file']], params.get('emulsion'), params.get('profile'))
+                    if film_base_rgb is None:
+                        raise ValueError('No film base found in the rebate, film_base_rgb or'
+                                         ' film_base_raw_file is required')
+                result = neg_batch.develop_frame(
+                    self._processor, params['raw_file'], film_base_rgb,
+                    emulsion=params.get('emulsion'),
+                    profile_name=params.get('profile'),
+                    exposure_comp=params.get('exposure_comp'),
+                    post_correction_gamma=params.get('post_correction_gamma', 1.0),
+                    colorspace=params.get('colorspace'),
+                    scale_down_factor=SCALE_DOWN_FACTORS[params.get('size', 'full')],
+                    no_crop=params.get('no_crop', False),
+                    out_dir=os.path.dirname(params['raw_file']),
+                    out_file=params.get('out_file'))
+            except Exception as e:
+                if self._processor.debug:
+                    traceback.print_exc()
+                self._update(job, status='failed', error=str(e), time=time.time() - start)
+                print('Job %d failed: %s' % (job['id'], e))
+                continue
+            self._update(job, status='done', result=result, time=time.time() - start)
+            print('Job %d done %s in %f seconds' % (job['id'], result['out_file'], result['time']))
+
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Set by serve().
+    job_queue = None
+
+    def address_string(self):
+        # client_address is an empty string for Unix sockets.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path.rstrip('/')
+        if path == '/jobs':
+            self._send_json(200, self.job_queue.jobs())
+            return
+        if path.startswith('/jobs/') and path[len('/jobs/'):].isdigit():
+            job = self.job_queue.status(int(path[len('/jobs/'):]))
+            if job:
+                self._send_json(200, job)
+                return
+        self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.job_queue.submit(params)
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        if urllib.parse.parse_qs(url.query).get('wait', ['0'])[0] not in ['0', '']:
+            # None if the job was already forgotten.
+            job = self.job_queue.wait(job['id']) or job
+        self._send_json(202 if job['status'] == 'queued' else 200, job)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(processor, port=8765, socket_path=None, film_base_rgb=None, workers=1):
+    '''Serves conversion jobs on localhost:|port|, or on the Unix socket |socket_path|
+    if given, until interrupted.'''
+    JobRequestHandler.job_queue = JobQueue(processor, film_base_rgb, workers)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, JobRequestHandler)
+        print('Serving jobs on %s' % socket_path)
+    else:
+        # Only local clients, the jobs read and write arbitrary files.
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), JobRequestHandler)
+        print('Serving jobs on http://127.0.0.1:%d' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped serving.')
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,356 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Writer of 16-bit RGB TIFF files with an embedded ICC profile, the same kind of
+# file written by bin_out/neg_process. cv2.imwrite() can't embed ICC profiles.
+#
+# Images can be written strip by strip with TiffWriter so the whole image doesn't
+# need to be in memory. Files of 4GB or more are written as BigTIFF.
+#
+# Strips can be compressed with Deflate, ZSTD or LZW after the horizontal predictor,
+# on a pool of threads. ZSTD needs the zstandard or imagecodecs module and LZW needs
+# imagecodecs. Run this file with a TIFF to benchmark the compression levels.
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+# TIFF field types.
+TYPE_SHORT = 3
+TYPE_LONG = 4
+TYPE_RATIONAL = 5
+TYPE_UNDEFINED = 7
+TYPE_LONG8 = 16
+
+# TIFF tags.
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_X_RESOLUTION = 282
+TAG_Y_RESOLUTION = 283
+TAG_PLANAR_CONFIG = 284
+TAG_RESOLUTION_UNIT = 296
+TAG_PREDICTOR = 317
+TAG_ICC_PROFILE = 34675
+
+# Values of TAG_COMPRESSION by name.
+COMPRESSIONS = {'none': 1, 'lzw': 5, 'deflate': 8, 'zstd': 50000}
+# Levels used when none is given and the valid levels, LZW has no levels.
+DEFAULT_LEVELS = {'deflate': 6, 'zstd': 3}
+LEVELS = {'deflate': range(0, 10), 'zstd': range(1, 23)}
+# Horizontal differencing.
+PREDICTOR_HORIZONTAL = 2
+
+_TYPE_FORMATS = {TYPE_SHORT: 'H', TYPE_LONG: 'I', TYPE_RATIONAL: 'II', TYPE_UNDEFINED: 'B', TYPE_LONG8: 'Q'}
+
+# Size of the BigTIFF header, space for it is kept in all files so the format can
+# be chosen when the file is closed.
+HEADER_SIZE = 16
+
+
+def _pack_values(field_type, values):
+    if field_type == TYPE_UNDEFINED:
+        return bytes(values)
+    if field_type == TYPE_RATIONAL:
+        values = [x for rational in values for x in rational]
+        return struct.pack('<%dI' % len(values), *values)
+    return struct.pack('<%d%s' % (len(values), _TYPE_FORMATS[field_type]), *values)
+
+
+def _write_ifd(f, fields, bigtiff=False):
+    '''Writes the IFD with |fields|, a list of (tag, type, values), at the end of |f|.
+    Values that don't fit in the entry are written before the IFD. Returns the offset
+    of the IFD.'''
+    # Sizes of the count and offset of an entry are 4 bytes in TIFF and 8 bytes in BigTIFF.
+    entry_format, count_format, value_size = ('<HHQ', '<Q', 8) if bigtiff else ('<HHI', '<H', 4)
+    entries = []
+    for tag, field_type, values in sorted(fields, key=lambda x: x[0]):
+        data = _pack_values(field_type, values)
+        count = len(values)
+        if len(data) <= value_size:
+            value = data.ljust(value_size, b'\0')
+        else:
+            # Values are word aligned.
+            if f.tell() % 2:
+                f.write(b'\0')
+            value = struct.pack('<Q' if bigtiff else '<I', f.tell())
+            f.write(data)
+        entries.append(struct.pack(entry_format, tag, field_type, count) + value)
+    if f.tell() % 2:
+        f.write(b'\0')
+    ifd_offset = f.tell()
+    f.write(struct.pack(count_format, len(entries)))
+    f.write(b''.join(entries))
+    # No next IFD.
+    f.write(struct.pack('<Q' if bigtiff else '<I', 0))
+    return ifd_offset
+
+
+def compressor(compression, level=None):
+    '''Returns a function compressing bytes with |compression|, a key of COMPRESSIONS
+    other than 'none', at |level| or the default level. Raises ValueError if the level
+    isn't valid for |compression| or the module needed isn't installed.'''
+    if compression not in COMPRESSIONS or compression == 'none':
+        raise ValueError('Unknown compression %s' % compression)
+    if level is None:
+        level = DEFAULT_LEVELS.get(compression)
+    elif compression not in LEVELS:
+        raise ValueError('Compression %s has no levels' % compression)
+    elif level not in LEVELS[compression]:
+        raise ValueError('Level of compression %s must be %d to %d, got %d' % (
+            compression, LEVELS[compression][0], LEVELS[compression][-1], level))
+    if compression == 'deflate':
+        return lambda data: zlib.compress(data, level)
+    if compression == 'zstd':
+        if zstandard:
+            # Compressors can't be shared by threads.
+            return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+        if imagecodecs:
+            return lambda data: imagecodecs.zstd_encode(data, level)
+        raise ValueError('ZSTD compression needs the zstandard or imagecodecs module')
+    if imagecodecs:
+        return imagecodecs.lzw_encode
+    raise ValueError('LZW compression needs the imagecodecs module')
+
+
+def predict_horizontal(strip):
+    '''Returns |strip| with each sample replaced by the difference from the same sample
+    of the pixel to the left, modulo 2^16, as TIFF predictor 2.'''
+    diff = strip.copy()
+    diff[:, 1:] -= strip[:, :-1]
+    return diff
+
+
+class TiffWriter:
+    '''Writes a 16-bit RGB TIFF to |path| strip by strip. Rows are passed to write() in
+    any number and are written in strips of |rows_per_strip| rows, the IFD is written by
+    close(). BigTIFF is used if the file would be too large for TIFF, or if |bigtiff|
+    is set. |icc_profile| is the bytes of the ICC profile to embed.
+
+    If |compression| is a key of COMPRESSIONS other than 'none', the strips are
+    compressed at |level| after the horizontal predictor on |threads| threads, all the
+    cores by default. The strips are written in order as they are compressed. Writers
+    of several files at the same time can share the ThreadPoolExecutor |executor| of
+    |threads| threads instead, it isn't shut down by the writer.'''
+
+    def __init__(self, path, icc_profile=None, rows_per_strip=64, bigtiff=False, compression=None, level=None,
+                 threads=None, executor=None):
+        self.icc_profile = icc_profile
+        self.rows_per_strip = rows_per_strip
+        self.bigtiff = bigtiff
+        self.compression = compression if compression != 'none' else None
+        self._compress = None
+        self._executor = None
+        if self.compression:
+            self._compress = compressor(self.compression, level)
+            threads = threads or os.cpu_count() or 1
+            self._own_executor = executor is None
+            self._executor = executor or concurrent.futures.ThreadPoolExecutor(threads)
+            # Strips being compressed, in order. A few strips per thread are queued so the
+            # threads don't wait for the writes.
+            self._compressing = collections.deque()
+            self._max_compressing = 2 * threads
+        self.width = None
+        self.height = 0
+        self.samples = 3
+        self._strip_offsets = []
+        self._strip_byte_counts = []
+        # Rows that don't fill a strip yet.
+        self._pending = []
+        self._pending_rows = 0
+        self._f = open(path, 'wb')
+        self._f.write(b'\0' * HEADER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self._executor and self._own_executor:
+                self._executor.shutdown(cancel_futures=True)
+            self._f.close()
+
+    def write(self, rows):
+        '''Appends the N x W x 3 uint16 |rows| to the image.'''
+        rows = np.ascontiguousarray(rows, dtype='<u2')
+        if self.width is None:
+            _, self.width, self.samples = rows.shape
+        self.height += len(rows)
+        self._pending.append(rows)
+        self._pending_rows += len(rows)
+        if self._pending_rows >= self.rows_per_strip:
+            pending = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+            full = len(pending) - len(pending) % self.rows_per_strip
+            for y in range(0, full, self.rows_per_strip):
+                self._write_strip(pending[y:y + self.rows_per_strip])
+            self._pending = [pending[full:]] if full < len(pending) else []
+            self._pending_rows = len(pending) - full
+
+    def _write_strip(self, strip):
+        if not self._compress:
+            self._write_data(strip.data)
+            return
+        self._compressing.append(self._executor.submit(self._compress_strip, strip))
+        while len(self._compressing) > self._max_compressing:
+            self._write_data(self._compressing.popleft().result())
+
+    def _compress_strip(self, strip):
+        # zlib, zstandard and imagecodecs release the GIL while compressing.
+        return self._compress(predict_horizontal(strip).tobytes())
+
+    def _write_data(self, data):
+        self._strip_offsets.append(self._f.tell())
+        self._strip_byte_counts.append(memoryview(data).nbytes)
+        self._f.write(data)
+
+    def close(self):
+        if self._pending:
+            self._write_strip(np.concatenate(self._pending))
+            self._pending = []
+        if self._executor:
+            while self._compressing:
+                self._write_data(self._compressing.popleft().result())
+            if self._own_executor:
+                self._executor.shutdown()
+        f = self._f
+        icc_size = len(self.icc_profile) if self.icc_profile else 0
+        # Offsets and the IFD have to fit in 32 bits in TIFF.
+        if f.tell() + icc_size + 8 * len(self._strip_offsets) + 1024 >= 1 << 32:
+            self.bigtiff = True
+        offset_type = TYPE_LONG8 if self.bigtiff else TYPE_LONG
+        fields = [
+            (TAG_IMAGE_WIDTH, TYPE_LONG, [self.width or 0]),
+            (TAG_IMAGE_LENGTH, TYPE_LONG, [self.height]),
+            (TAG_BITS_PER_SAMPLE, TYPE_SHORT, [16] * self.samples),
+            (TAG_COMPRESSION, TYPE_SHORT, [COMPRESSIONS[self.compression or 'none']]),
+            # RGB.
+            (TAG_PHOTOMETRIC, TYPE_SHORT, [2]),
+            (TAG_STRIP_OFFSETS, offset_type, self._strip_offsets),
+            (TAG_SAMPLES_PER_PIXEL, TYPE_SHORT, [self.samples]),
+            (TAG_ROWS_PER_STRIP, TYPE_LONG, [self.rows_per_strip]),
+            (TAG_STRIP_BYTE_COUNTS, offset_type, self._strip_byte_counts),
+            (TAG_X_RESOLUTION, TYPE_RATIONAL, [(300, 1)]),
+            (TAG_Y_RESOLUTION, TYPE_RATIONAL, [(300, 1)]),
+            # Chunky.
+            (TAG_PLANAR_CONFIG, TYPE_SHORT, [1]),
+            # Inch.
+            (TAG_RESOLUTION_UNIT, TYPE_SHORT, [2]),
+            ]
+        if self.compression:
+            fields.append((TAG_PREDICTOR, TYPE_SHORT, [PREDICTOR_HORIZONTAL]))
+        if self.icc_profile:
+            fields.append((TAG_ICC_PROFILE, TYPE_UNDEFINED, self.icc_profile))
+        ifd_offset = _write_ifd(f, fields, self.bigtiff)
+        f.seek(0)
+        if self.bigtiff:
+            # Little endian, version 43, 8 byte offsets.
+            f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, ifd_offset))
+        else:
+            f.write(b'II*\0' + struct.pack('<I', ifd_offset))
+        f.close()
+
+
+def write_tiff(path, img, icc_profile=None, rows_per_strip=64, compression=None, level=None):
+    '''Writes the H x W x 3 uint16 RGB |img| to |path| as a TIFF, uncompressed unless
+    |compression| is given, see TiffWriter. |icc_profile| is the bytes of the ICC profile
+    to embed.'''
+    with TiffWriter(path, icc_profile, rows_per_strip, compression=compression, level=level) as writer:
+        writer.write(img)
+
+
+def benchmark(img, compressions, threads=None, rows_per_strip=64):
+    '''Writes |img| with each of the |compressions|, a list of (compression, level),
+    and prints the time, throughput and size of each.'''
+    print('%-8s %5s %8s %10s %10s %6s' % ('', 'Level', 'Seconds', 'MB/s', 'MB', 'Ratio'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'benchmark.tif')
+        for compression, level in compressions:
+            start = time.time()
+            with TiffWriter(path, None, rows_per_strip, compression=compression, level=level,
+                            threads=threads) as writer:
+                writer.write(img)
+            elapsed = time.time() - start
+            size = os.path.getsize(path)
+            print('%-8s %5s %8.2f %10.1f %10.1f %6.2f' % (
+                compression, '-' if level is None else level, elapsed, img.nbytes / elapsed / 1e6,
+                size / 1e6, img.nbytes / size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the compressions of TIFF output on a 16-bit RGB TIFF, e.g. one"
+        " written by neg_process.py.")
+    parser.add_argument('tiff_file')
+    parser.add_argument(
+        '--compression', default='deflate,zstd,lzw',
+        help="Comma separated compressions to benchmark, of %s." % ', '.join(COMPRESSIONS))
+    parser.add_argument(
+        '--levels', default='1,3,6,9',
+        help="Comma separated levels of Deflate and ZSTD.")
+    parser.add_argument(
+        '--threads', type=int,
+        help="Compression threads, all the cores by default.")
+    args = parser.parse_args(argv)
+    # Imported here, cv2 isn't needed to write TIFF files.
+    import cv2
+    img = cv2.imread(args.tiff_file, cv2.IMREAD_UNCHANGED)
+    if img is None or img.dtype != np.uint16 or img.ndim != 3:
+        print('%s is not a 16-bit RGB image' % args.tiff_file)
+        return 1
+    img = np.ascontiguousarray(img[:, :, 2::-1])
+    levels = list(map(int, args.levels.split(',')))
+    compressions = [('none', None)]
+    for compression in args.compression.split(','):
+        try:
+            compressor(compression)
+        except ValueError as e:
+            print('Skipping %s: %s' % (compression, e))
+            continue
+        if compression in DEFAULT_LEVELS:
+            compressions += [(compression, level) for level in levels]
+        else:
+            compressions.append((compression, None))
+    print('%s: %dx%d, %.1f MB' % (args.tiff_file, img.shape[1], img.shape[0], img.nbytes / 1e6))
+    benchmark(img, compressions, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# Copyright 2024 Alpha Lam <arufa.hc@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Watch mode of neg_process.py for tethered scanning sessions. RAW files that
+# arrive in a directory are developed as soon as they are completely written,
+# using the pipeline of neg_batch.py with the same NegativeProcessor for the whole
+# session so profiles and ICC transforms are loaded only once.
+
+import os
+import time
+import neg_batch
+
+
+def arrived_raw_files(directory, poll_interval=1.0, settle_time=2.0, exclude=[], multi_shot=False):
+    '''Yields the RAW files that arrive in |directory|, files that are already there
+    are skipped. A file is yielded once its size and modification time haven't
+    changed for |settle_time| seconds, i.e. the camera software is done writing it.
+    In multi-shot mode only the first file of every 4 is yielded.'''
+    seen = set(neg_batch.list_raw_files(directory, exclude))
+    # Files still being written: file -> ((size, mtime), time when that stat was first seen).
+    pending = {}
+    shots = []
+    while True:
+        now = time.time()
+        arrived = []
+        for raw_file in neg_batch.list_raw_files(directory, exclude):
+            if raw_file in seen:
+                continue
+            try:
+                st = os.stat(raw_file)
+            except FileNotFoundError:
+                continue
+            stat = (st.st_size, st.st_mtime_ns)
+            if raw_file not in pending or pending[raw_file][0] != stat:
+                pending[raw_file] = (stat, now)
+                continue
+            if st.st_size == 0 or now - pending[raw_file][1] < settle_time:
+                continue
+            del pending[raw_file]
+            seen.add(raw_file)
+            arrived.append(raw_file)
+        for raw_file in sorted(arrived):
+            if not multi_shot:
+                yield raw_file
+                continue
+            shots.append(raw_file)
+            if len(shots) == 4:
+                yield shots[0]
+                shots = []
+        time.sleep(poll_interval)
+
+
+def watch(processor, directory, film_base_rgb, queue_size=2, poll_interval=1.0, settle_time=2.0,
+          exclude=[], **frame_args):
+    '''Develops RAW files arriving in |directory| until interrupted. The positives are
+    written next to the RAW files. |frame_args| are the same as for
+    neg_batch.process_roll_pipelined().'''
+    print('Watching %s for new raw files, press Ctrl-C to stop.' % directory)
+    try:
+        neg_batch.process_roll_pipelined(
+            processor,
+            arrived_raw_files(directory, poll_interval, settle_time, exclude, processor.multi_shot),
+            film_base_rgb, queue_size, out_dir=directory, **frame_args)
+    except KeyboardInterrupt:
+        print('Stopped watching %s.' % directory)
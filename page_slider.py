@@ -18,16 +18,21 @@ class PageSlider(matplotlib.widgets.Slider):
 
         self.poly.set_visible(False)
         self.vline.set_visible(False)
+        # Only the pages that change colour are redrawn, see _colorize().
+        self.drawon = False
         self.pageRects = []
+        self.pageTexts = []
+        self.activePage = valinit - min_page
         for i in range(min_page, max_page+1):
             facecolor = self.activecolor if i==valinit else self.facecolor
             r  = matplotlib.patches.Rectangle((float(i-min_page)/self.numpages, 0), 1./self.numpages, 1, 
                                 transform=ax.transAxes, facecolor=facecolor)
             ax.add_artist(r)
             self.pageRects.append(r)
-            ax.text(float(i-min_page)/self.numpages+0.5/self.numpages, 0.5, str(i),
-                    ha="center", va="center", transform=ax.transAxes,
-                    fontsize=self.fontsize)
+            t = ax.text(float(i-min_page)/self.numpages+0.5/self.numpages, 0.5, str(i),
+                        ha="center", va="center", transform=ax.transAxes,
+                        fontsize=self.fontsize)
+            self.pageTexts.append(t)
         self.valtext.set_visible(False)
 
         divider = make_axes_locatable(ax)
@@ -42,12 +47,13 @@ class PageSlider(matplotlib.widgets.Slider):
         self.button_back.on_clicked(self.backward)
         self.button_forward.on_clicked(self.forward)
 
-    def _update(self, event):
-        super(PageSlider, self)._update(event)
-        i = self._int_val(self.val)
-        if i >= self.valmax:
-            i = self.valmax
-        self._colorize(i - self.min_page)
+    def set_val(self, val):
+        super(PageSlider, self).set_val(val)
+        if not hasattr(self, 'pageRects'):
+            # Called by Slider.__init__().
+            return
+        i = min(max(self._int_val(val), self.valmin), self.valmax)
+        self._colorize(int(i) - self.min_page)
 
     def _int_val(self, val):
         i = 0
@@ -61,9 +67,20 @@ class PageSlider(matplotlib.widgets.Slider):
         super(PageSlider, self).on_changed(lambda val: func(self._int_val(val)))
 
     def _colorize(self, i):
-        for j in range(self.numpages):
-            self.pageRects[j].set_facecolor(self.facecolor)
+        if i == self.activePage:
+            return
+        changed = [self.activePage, i]
+        self.pageRects[self.activePage].set_facecolor(self.facecolor)
         self.pageRects[i].set_facecolor(self.activecolor)
+        self.activePage = i
+        canvas = self.ax.figure.canvas
+        if not canvas.supports_blit:
+            canvas.draw_idle()
+            return
+        for j in changed:
+            self.ax.draw_artist(self.pageRects[j])
+            self.ax.draw_artist(self.pageTexts[j])
+        canvas.blit(self.ax.bbox)
 
     def forward(self, event):
         current_i = 0
@@ -75,7 +92,6 @@ class PageSlider(matplotlib.widgets.Slider):
         if (i < self.valmin) or (i > self.valmax):
             return
         self.set_val(i)
-        self._colorize(i - self.min_page)
 
     def backward(self, event):
         current_i = 0
@@ -87,4 +103,3 @@ class PageSlider(matplotlib.widgets.Slider):
         if (i < self.valmin) or (i > self.valmax):
             return
         self.set_val(i)
-        self._colorize(i - self.min_page)
@@ -3,6 +3,8 @@
 #include <time.h>
 #include <math.h>
 
+#include <vector>
+
 #include "libraw/libraw.h"
 
 enum MODE {
@@ -10,6 +12,8 @@ enum MODE {
   SHUTTER_SPEED = 1,
   ISO = 2,
   CENTER_WEIGHT_AVERAGE = 4,
+  DIMENSIONS = 8,
+  FILE_NAME = 16,
 };
 
 void print_center_weight_averages(ushort (*image)[4], ushort width, ushort height) {
@@ -46,13 +50,14 @@ int main(int ac, char *av[]) {
 	     "Usage: %s [options] raw-files....\n"
 	     "  -s: Shutter speed.\n"
 	     "  -i: ISO.\n"
-	     "  -w: Compute center-weight average.\n",
+	     "  -w: Compute center-weight average.\n"
+	     "  -d: Image size.\n"
+	     "  -f: File name before the info of each file, for reading many files at once.\n",
 	     LibRaw::version(), av[0]);
       return 0;
   }
 
-  char* files[16];
-  int fp = 0;
+  std::vector<char*> files;
   int mode = 0;
   for (int i = 1; i < ac; i++) {
     if (av[i][0] == '-') {
@@ -60,22 +65,31 @@ int main(int ac, char *av[]) {
       case 's': mode |= SHUTTER_SPEED; break;
       case 'i': mode |= ISO; break;
       case 'w': mode |= CENTER_WEIGHT_AVERAGE; break;
+      case 'd': mode |= DIMENSIONS; break;
+      case 'f': mode |= FILE_NAME; break;
       default:
 	goto usage;
 	continue;
       }
     } else {
-      files[fp++] = av[i];
+      files.push_back(av[i]);
     }
   }
 
-  for (int i = 0; i < fp; ++i) {
+  int status = 0;
+  for (int i = 0; i < files.size(); ++i) {
     int ret;
     LibRaw* proc = new LibRaw();
     char* fn = files[i];
     if ((ret = proc->open_file(fn)) != LIBRAW_SUCCESS) {
+      // Keep going with the other files.
       fprintf(stderr, "Cannot open %s: %s\n", fn, libraw_strerror(ret));
-      return 1;
+      delete proc;
+      status = 1;
+      continue;
+    }
+    if (mode & FILE_NAME) {
+      printf("%s # File\n", fn);
     }
     if (mode & SHUTTER_SPEED) {
       printf("%f # Shutter speed\n", proc->imgdata.other.shutter);
@@ -83,10 +97,15 @@ int main(int ac, char *av[]) {
     if (mode & ISO) {
       printf("%f # ISO speed\n", proc->imgdata.other.iso_speed);
     }
+    if (mode & DIMENSIONS) {
+      printf("%d %d # Image size\n", proc->imgdata.sizes.width, proc->imgdata.sizes.height);
+    }
     if (mode & CENTER_WEIGHT_AVERAGE) {
       if ((ret = proc->unpack()) != LIBRAW_SUCCESS) {
         fprintf(stderr, "Cannot unpack %s: %s\n", fn, libraw_strerror(ret));
-        return -1;
+        delete proc;
+        status = 1;
+        continue;
       }
       // Params needed to perform half size linear conversion.
       proc->imgdata.params.output_bps = 16;
@@ -111,6 +130,7 @@ int main(int ac, char *av[]) {
       proc->dcraw_process();
       print_center_weight_averages(proc->imgdata.image, proc->imgdata.sizes.iwidth, proc->imgdata.sizes.iheight);
     }
+    delete proc;
   }
-  return 0;
+  return status;
 }